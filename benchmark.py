@@ -0,0 +1,368 @@
+#!/usr/bin/python3
+import argparse
+import contextlib
+import json
+import math
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from src.Config import Config, ConfigKeys
+from src.Location import Position
+from src.Logger import Logger, LogEntry, LogLevel
+from src.RoutePlanner import RoutePlanner, RoutePlannerEngine, RouteTimeoutException, RouteConnectionChanges, RoutePath
+from src.CacheBuilder import CacheBuildMethod, make_tile_cache
+from src.StorageProvider import StorageProvider
+from src.TileCache import TileCacheFile
+
+
+def make_queries(storage: StorageProvider, num_queries: int, seed: int, spread: int = 300):
+    rng = random.Random(seed)
+    locations = storage.get_locations()
+    queries = []
+    for _ in range(num_queries):
+        from_x, from_y = locations[rng.randrange(len(locations))].get_pos()
+        to_x, to_y = locations[rng.randrange(len(locations))].get_pos()
+        queries.append((
+            Position(from_x + rng.randint(-spread, spread), from_y + rng.randint(-spread, spread)),
+            Position(to_x + rng.randint(-spread, spread), to_y + rng.randint(-spread, spread))
+        ))
+    return queries
+
+
+def get_trip_kind(route_entries) -> str:
+    board_name = RoutePath._cls_route_connection_changes_name_map[RouteConnectionChanges.BoardTrain]
+    change_name = RoutePath._cls_route_connection_changes_name_map[RouteConnectionChanges.ChangeTrain]
+    boardings = sum(1 for entry in route_entries if entry["type"] in [board_name, change_name])
+    if boardings == 0:
+        return "walk"
+    elif boardings == 1:
+        return "single_line"
+    return "multi_transfer"
+
+
+def make_trips(storage: StorageProvider, planner: RoutePlanner, num_per_kind: int, seed: int):
+    """
+    Seeded trips of every kind, classified by the route the location graph finds for them
+    """
+    rng = random.Random(seed)
+    locations = storage.get_locations()
+    trips = {kind: [] for kind in ["walk", "single_line", "multi_transfer"]}
+    for _ in range(num_per_kind * 200):
+        if all(len(kind_trips) >= num_per_kind for kind_trips in trips.values()):
+            break
+        from_x, from_y = locations[rng.randrange(len(locations))].get_pos()
+        if rng.random() < 0.3:
+            # short trips are mostly walked
+            to_x, to_y = from_x + rng.randint(-150, 150), from_y + rng.randint(-150, 150)
+        else:
+            to_x, to_y = locations[rng.randrange(len(locations))].get_pos()
+            to_x, to_y = to_x + rng.randint(-100, 100), to_y + rng.randint(-100, 100)
+        from_pos = Position(from_x + rng.randint(-100, 100), from_y + rng.randint(-100, 100))
+        to_pos = Position(to_x, to_y)
+        route = planner.plan_route(from_pos, to_pos, None, RoutePlannerEngine.LocationGraph)
+        kind_trips = trips[get_trip_kind(route.get_entries())]
+        if len(kind_trips) < num_per_kind:
+            kind_trips.append((from_pos, to_pos))
+    return trips
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_latencies(latencies_ms):
+    if not latencies_ms:
+        return "no completed queries"
+    return "mean {:.3f} ms, median {:.3f} ms, max {:.3f} ms".format(
+        statistics.mean(latencies_ms), statistics.median(latencies_ms), max(latencies_ms))
+
+
+def _format_number(value):
+    return "-" if value is None else "{:.3f}".format(value)
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.config = Config(args.config)
+        self.logger = Logger.create(
+            self.config.get_config_value(ConfigKeys.LoggerType),
+            self.config.get_config_value(ConfigKeys.LoggerConfig)
+        )
+        storage_config = dict(self.config.get_config_value(ConfigKeys.StorageProviderConfig))
+        if args.no_snapshot:
+            storage_config["snapshot_path"] = None
+        begin_time = time.perf_counter()
+        self.storage = StorageProvider.create(
+            self.logger,
+            self.config.get_config_value(ConfigKeys.StorageProviderType),
+            storage_config
+        )
+        self.storage_load_ms = (time.perf_counter() - begin_time) * 1000
+
+    def run_engines(self):
+        queries = make_queries(self.storage, self.args.queries, self.args.seed)
+        planner = RoutePlanner(self.storage)
+        for engine_name in self.args.engines:
+            engine = RoutePlannerEngine.from_value(engine_name)
+            begin_time = time.perf_counter()
+            # preprocessing is not part of the query latency
+            planner.prepare(engine, None)
+            planner.plan_route(queries[0][0], queries[0][0], self.args.timeout_ms, engine)
+            print("{}: prepared in {:.3f} ms".format(engine.value, (time.perf_counter() - begin_time) * 1000))
+
+            latencies_ms = []
+            timeouts = 0
+            for from_pos, to_pos in queries:
+                begin_time = time.perf_counter()
+                try:
+                    planner.plan_route(from_pos, to_pos, self.args.timeout_ms, engine)
+                except RouteTimeoutException:
+                    timeouts += 1
+                    continue
+                latencies_ms.append((time.perf_counter() - begin_time) * 1000)
+            print("{}: {}, {} timeouts".format(engine.value, format_latencies(latencies_ms), timeouts))
+
+    def _measure_trips(self, planner: RoutePlanner, engine: RoutePlannerEngine, trips):
+        latencies_ms = []
+        nodes_expanded = []
+        timeouts = 0
+        for from_pos, to_pos in trips:
+            begin_time = time.perf_counter()
+            try:
+                route = planner.plan_route(from_pos, to_pos, self.args.timeout_ms, engine)
+            except RouteTimeoutException:
+                timeouts += 1
+                continue
+            latencies_ms.append((time.perf_counter() - begin_time) * 1000)
+            nodes_expanded.append(route.get_stats().nodes_expanded)
+
+        # a separate pass, tracing allocations slows every query down
+        peak_bytes = 0
+        if not self.args.no_memory:
+            tracemalloc.start()
+            for from_pos, to_pos in trips:
+                tracemalloc.reset_peak()
+                try:
+                    planner.plan_route(from_pos, to_pos, self.args.timeout_ms, engine)
+                except RouteTimeoutException:
+                    pass
+                peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        return {
+            "queries": len(trips),
+            "timeouts": timeouts,
+            "latency_ms": {
+                "mean": statistics.mean(latencies_ms) if latencies_ms else None,
+                "p50": percentile(latencies_ms, 50),
+                "p95": percentile(latencies_ms, 95),
+                "p99": percentile(latencies_ms, 99),
+                "max": max(latencies_ms, default=None)
+            },
+            "nodes_expanded": {
+                "mean": statistics.mean(nodes_expanded) if nodes_expanded else None,
+                "max": max(nodes_expanded, default=None)
+            },
+            "peak_memory_bytes": peak_bytes if not self.args.no_memory else None
+        }
+
+    def run_routes(self):
+        planner = RoutePlanner(self.storage)
+        trips = make_trips(self.storage, planner, self.args.queries, self.args.seed)
+        results = {
+            "commit": get_git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "seed": self.args.seed,
+            "timeout_ms": self.args.timeout_ms,
+            "engines": {}
+        }
+
+        for engine_name in self.args.engines:
+            engine = RoutePlannerEngine.from_value(engine_name)
+            begin_time = time.perf_counter()
+            # preprocessing is not part of the query latency
+            planner.prepare(engine, None)
+            planner.plan_route(Position(0, 0), Position(0, 0), self.args.timeout_ms, engine)
+            engine_results = {
+                "prepare_ms": (time.perf_counter() - begin_time) * 1000,
+                "trips": {}
+            }
+            for kind, kind_trips in trips.items():
+                kind_results = self._measure_trips(planner, engine, kind_trips)
+                engine_results["trips"][kind] = kind_results
+                latency = kind_results["latency_ms"]
+                print("{} {}: {} queries, p50 {} ms, p95 {} ms, p99 {} ms, {} nodes expanded on average, "
+                      "{} timeouts, peak {} KiB".format(
+                        engine.value, kind, kind_results["queries"], _format_number(latency["p50"]),
+                        _format_number(latency["p95"]), _format_number(latency["p99"]),
+                        _format_number(kind_results["nodes_expanded"]["mean"]), kind_results["timeouts"],
+                        _format_number(kind_results["peak_memory_bytes"] / 1024
+                                       if kind_results["peak_memory_bytes"] is not None else None)))
+            results["engines"][engine.value] = engine_results
+
+        with open(self.args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print("Results written to {}".format(self.args.output))
+
+    def run_cache(self):
+        min_x, max_x, min_y, max_y = self.args.cache_rect
+        num_cells = (max_x - min_x + 1) * (max_y - min_y + 1)
+        # keep the benchmark from replacing the cache the server uses
+        self.storage.tile_cache_path = self.args.cache_output
+
+        for method in [CacheBuildMethod.Vectorised, CacheBuildMethod.Pool]:
+            shutil.rmtree(self.args.cache_output, ignore_errors=True)
+            begin_time = time.perf_counter()
+            self.storage.make_cache(min_x, max_x, min_y, max_y, self.args.threads, lambda *_: None, method)
+            elapsed = time.perf_counter() - begin_time
+            print("{}: {} cells in {:.3f} s, {:.0f} cells/s".format(method.value, num_cells, elapsed,
+                                                                   num_cells / elapsed))
+
+            # the same cache after one station was removed
+            stations = self.storage.station_index.get_station_positions()
+            if stations:
+                file_name = TileCacheFile.get_file_name("heuristic", self.storage.tile_size, min_x, max_x, min_y, max_y)
+                begin_time = time.perf_counter()
+                make_tile_cache(stations[1:], os.path.join(self.args.cache_output, file_name), min_x, max_x, min_y,
+                                max_y, self.storage.tile_size, self.args.threads, method, lambda *_: None)
+                print("{}: update after one station change in {:.3f} s".format(method.value,
+                                                                            time.perf_counter() - begin_time))
+        shutil.rmtree(self.args.cache_output, ignore_errors=True)
+
+    def run_first_route(self):
+        """
+        Plan one route right after loading, the startup suite runs this in a fresh interpreter
+        """
+        # along one connection, the search itself is measured by the other suites
+        connection = random.Random(self.args.seed).choice(self.storage.get_connections())
+        from_pos, to_pos = [Position(*location.get_pos()) for location in connection.get_locations()]
+        begin_time = time.perf_counter()
+        RoutePlanner(self.storage).plan_route(from_pos, to_pos, self.args.timeout_ms)
+        print(json.dumps({
+            "storage_load_ms": self.storage_load_ms,
+            "first_route_ms": (time.perf_counter() - begin_time) * 1000
+        }), flush=True)
+
+    def _measure_startup(self, no_snapshot: bool):
+        command = [sys.executable, os.path.abspath(__file__), "first_route", "--config", self.args.config,
+                   "--seed", str(self.args.seed), "--timeout-ms", str(self.args.timeout_ms)]
+        if no_snapshot:
+            command.append("--no-snapshot")
+        begin_time = time.perf_counter()
+        with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as process:
+            # loading may log before the result, tearing the process down is not part of the startup
+            result = None
+            for line in process.stdout:
+                if line.startswith("{"):
+                    result = json.loads(line)
+                    result["first_response_ms"] = (time.perf_counter() - begin_time) * 1000
+            if process.wait() != 0 or result is None:
+                raise RuntimeError("{} failed".format(" ".join(command)))
+        return result
+
+    def run_startup(self):
+        """
+        Time from starting a process to its first planned route, parsing the json storage against loading a
+        snapshot. The first snapshot run starts without a snapshot and writes it.
+        """
+        snapshot_path = self.config.get_config_value(ConfigKeys.StorageProviderConfig).get("snapshot_path")
+        runs = {"json": [self._measure_startup(True) for _ in range(self.args.runs)]}
+        if snapshot_path is not None:
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+            runs["snapshot_cold"] = [self._measure_startup(False)]
+            runs["snapshot"] = [self._measure_startup(False) for _ in range(self.args.runs)]
+
+        results = {
+            "commit": get_git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "modes": {}
+        }
+        for mode, mode_runs in runs.items():
+            results["modes"][mode] = {key: statistics.median(run[key] for run in mode_runs) for key in mode_runs[0]}
+            print("{}: first response after {:.0f} ms, storage loaded in {:.0f} ms, first route {:.1f} ms".format(
+                mode, results["modes"][mode]["first_response_ms"], results["modes"][mode]["storage_load_ms"],
+                results["modes"][mode]["first_route_ms"]))
+
+        with open(self.args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print("Results written to {}".format(self.args.output))
+
+    def run_logger(self):
+        """
+        Entries per second each logger type stores, until the last one is in the database, and how long add_entry
+        blocks the caller
+        """
+        for logger_type in ["db", "db_batched"]:
+            with tempfile.TemporaryDirectory() as temp_path:
+                logger = Logger.create(logger_type, {"db_path": os.path.join(temp_path, "log.db")})
+                add_latencies_ms = []
+                # both echo every entry
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    begin_time = time.perf_counter()
+                    for i in range(self.args.entries):
+                        add_begin_time = time.perf_counter()
+                        logger.add_entry(LogEntry.create(LogLevel.Info, "Benchmark entry {}".format(i)))
+                        add_latencies_ms.append((time.perf_counter() - add_begin_time) * 1000)
+                    logger.flush()
+                    elapsed = time.perf_counter() - begin_time
+                    logger.close()
+            print("{}: {} entries in {:.3f} s, {:.0f} entries/s, add_entry {}".format(
+                logger_type, self.args.entries, elapsed, self.args.entries / elapsed,
+                format_latencies(add_latencies_ms)))
+
+    def run(self):
+        suites = {
+            "engines": self.run_engines,
+            "routes": self.run_routes,
+            "cache": self.run_cache,
+            "startup": self.run_startup,
+            "logger": self.run_logger,
+            "first_route": self.run_first_route
+        }
+        suites[self.args.suite]()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the route planner")
+    parser.add_argument("suite", choices=["engines", "routes", "cache", "startup", "first_route", "logger"])
+    parser.add_argument("--config", default="./config.json")
+    # per trip kind for the routes suite
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout-ms", type=int, default=10_000)
+    parser.add_argument("--engines", nargs="+", default=[x.value for x in RoutePlannerEngine])
+    parser.add_argument("--cache-rect", type=int, nargs=4, default=[-1000, 1000, -1000, 1000],
+                        metavar=("MIN_X", "MAX_X", "MIN_Y", "MAX_Y"))
+    parser.add_argument("--cache-output", default="./benchmark_cache_tiles")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--output", default="./benchmark_results.json")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the allocation tracing pass")
+    # processes started per mode by the startup suite
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--no-snapshot", action="store_true", help="Always parse the json storage")
+    # written per logger type by the logger suite
+    parser.add_argument("--entries", type=int, default=5000)
+    Benchmark(parser.parse_args()).run()
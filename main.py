@@ -1,39 +1,89 @@
 #!/usr/bin/python3
-import gzip
-import sys
 import time
+
+# taken before the other imports, --startup-timing counts them
+_begin_time = time.perf_counter()
+
+import sys
 import traceback
 
 from src.Config import Config, ConfigKeys
-from src.Editor import EditorApplication
 from src.Logger import Logger, LogEntry, LogLevel
-from src.ServerNetworkInterface import ServerNetworkInterface, ClientNetworkInterface
 from src.StorageProvider import StorageProvider
 
 
+class StartupTiming:
+    """
+    Milliseconds spent in each phase of starting up, reported with --startup-timing
+    """
+    def __init__(self, begin_time: float):
+        self.last_time = begin_time
+        self.phases = {}
+
+    def add(self, phase: str):
+        """
+        Count the time since the last phase ended towards this one
+        """
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self.last_time) * 1000
+        self.last_time = now
+
+    def split(self, phase: str, part_phase: str, part_ms: float):
+        """
+        Move part of a phase that was measured within it to a phase of its own
+        """
+        self.phases[phase] -= part_ms
+        self.phases[part_phase] = self.phases.get(part_phase, 0.0) + part_ms
+
+    def report(self):
+        for phase, elapsed_ms in self.phases.items():
+            print("{:<10} {:>10.1f} ms".format(phase, elapsed_ms))
+        print("{:<10} {:>10.1f} ms".format("total", sum(self.phases.values())))
+
+
 class Application:
     def __init__(self):
+        self.timing = StartupTiming(_begin_time)
+        self.timing.add("import")
+
+        args = sys.argv[1:]
+        self.use_editor = "editor" in args if len(sys.argv) > 1 else False
+        self.as_client = "client" in args if len(sys.argv) > 1 else False
+        self.report_timing = "--startup-timing" in args
+
         self.config = Config("./config.json")
         self.logger = Logger.create(
             self.config.get_config_value(ConfigKeys.LoggerType),
             self.config.get_config_value(ConfigKeys.LoggerConfig)
         )
+        self.timing.add("config")
         print("Loading from storage")
         self.storage = StorageProvider.create(
             self.logger,
             self.config.get_config_value(ConfigKeys.StorageProviderType),
             self.config.get_config_value(ConfigKeys.StorageProviderConfig)
         )
+        self.timing.add("storage")
+        load_timings = self.storage.get_load_timings()
+        if "cache" in load_timings.keys():
+            self.timing.split("storage", "cache", load_timings["cache"])
 
-        args = sys.argv[1:]
-        self.use_editor = "editor" in args if len(sys.argv) > 1 else False
-        self.as_client = "client" in args if len(sys.argv) > 1 else False
+    def _started(self):
+        if self.report_timing:
+            self.timing.report()
 
     def run(self):
         try:
+            # every mode imports only what it uses, the server and client run without Qt
             if self.use_editor:
+                from src.Editor import EditorApplication
+                self.timing.add("import")
+                self._started()
                 EditorApplication(self.storage, self.config).run()
             elif self.as_client:
+                from src.ServerNetworkInterface import ClientNetworkInterface
+                self.timing.add("import")
+                self._started()
                 ClientNetworkInterface(self.config, self.storage).run()
             else:
                 """planner = RoutePlanner(self.storage)
@@ -46,10 +96,15 @@ class Application:
                     print(entry.get_entry_text())
     
                 self.plot_routemap(route)"""
+                from src.ServerNetworkInterface import ServerNetworkInterface
+                self.timing.add("import")
+                self._started()
                 ServerNetworkInterface(self.config, self.storage).run()
         except Exception as _e:
             self.logger.add_entry(LogEntry.create(LogLevel.Fatal, traceback.format_exc()))
             raise _e
+        finally:
+            self.logger.close()
 
 
 if __name__ == "__main__":
@@ -57,6 +112,7 @@ if __name__ == "__main__":
 
     if profile:
         import cProfile
+        import gzip
         from pycallgraph2 import PyCallGraph, GlobbingFilter, Config as PyCallGraphConfig
         from pycallgraph2.output import GraphvizOutput
         import pstats
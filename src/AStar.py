@@ -1,8 +1,9 @@
-import datetime
 import heapq
 import math
+import time
 import typing
 
+from src.Adjacency import AdjacencyGraph, get_connection_cost, pack_position, unpack_position
 from src.Location import Position
 from src.StorageProvider import StorageProvider
 
@@ -11,6 +12,67 @@ class AStarTimelimitException(Exception):
     pass
 
 
+class AStarBudgetException(AStarTimelimitException):
+    pass
+
+
+class SearchStats:
+    def __init__(self):
+        self.nodes_expanded = 0
+        self.nodes_pushed = 0
+        self.peak_heap_size = 0
+        self.heuristic_cache_hits = 0
+        self.elapsed_ms = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "nodes_expanded": self.nodes_expanded,
+            "nodes_pushed": self.nodes_pushed,
+            "peak_heap_size": self.peak_heap_size,
+            "heuristic_cache_hits": self.heuristic_cache_hits,
+            "elapsed_ms": self.elapsed_ms
+        }
+
+
+class SearchLimit:
+    """
+    Time limit and expansion budget of one search, filling in its stats. Reading the clock costs as much as a
+    few expansions, so the deadline is only checked every few expansions.
+    """
+    _cls_clock_check_interval = 64
+
+    def __init__(self, storage: StorageProvider, timelimit_ms: typing.Optional[int],
+                 max_expansions: typing.Optional[int], stats: typing.Optional[SearchStats]):
+        self.storage = storage
+        self.max_expansions = max_expansions
+        self.stats = stats if stats is not None else SearchStats()
+        self.begin_time = time.monotonic()
+        self.deadline = self.begin_time + timelimit_ms / 1000 if timelimit_ms is not None else None
+        # searches running at the same time on other threads count towards this as well
+        self.begin_cache_hits = storage.get_heuristic_cache_hits()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.stats.elapsed_ms = (time.monotonic() - self.begin_time) * 1000
+        self.stats.heuristic_cache_hits = self.storage.get_heuristic_cache_hits() - self.begin_cache_hits
+
+    def expand(self, heap_size: int):
+        stats = self.stats
+        stats.nodes_expanded += 1
+        if heap_size > stats.peak_heap_size:
+            stats.peak_heap_size = heap_size
+        if self.max_expansions is not None and stats.nodes_expanded > self.max_expansions:
+            raise AStarBudgetException()
+        if self.deadline is not None and stats.nodes_expanded % SearchLimit._cls_clock_check_interval == 0 and \
+                time.monotonic() > self.deadline:
+            raise AStarTimelimitException()
+
+    def push(self):
+        self.stats.nodes_pushed += 1
+
+
 class AStarPosition:
     def __init__(self, pos, connection):
         self.pos = pos
@@ -18,62 +80,103 @@ class AStarPosition:
 
 
 class AStar:
-    def __init__(self, storage: StorageProvider):
+    def __init__(self, storage: StorageProvider, max_expansions: typing.Optional[int] = None):
+        """
+        :param max_expansions: Searches expanding more nodes than this fail, None for no limit
+        """
         self.storage = storage
+        self.max_expansions = max_expansions
         self.heuristic_distance_threshold = 2000
+        # (packed offset, x offset, y offset) of the adjacent blocks
+        self.neighbour_offsets = [((offset_x << 32) + offset_y, offset_x, offset_y)
+                                  for offset_x, offset_y in storage.neighbour_directions.values()]
 
-    def get_path_to(self, start_pos: Position, end_pos: Position, timelimit_ms: typing.Optional[int]):
-        node_heap = []
-        heapq.heappush(node_heap, (0, start_pos.get_pos()))
-        node_map = {
-            start_pos.get_pos(): None
-        }
-        costs = {
-            start_pos.get_pos(): 0
-        }
-        begin_time = datetime.datetime.now()
-        timelimit_seconds = timelimit_ms / 1000
-        while not node_heap == []:
-            if timelimit_ms is not None and (datetime.datetime.now() - begin_time).total_seconds() > timelimit_seconds:
-                raise AStarTimelimitException()
-
-            current = heapq.heappop(node_heap)[1]
-
-            if current == end_pos.get_pos():
-                break
+    def get_path_to(self, start_pos: Position, end_pos: Position, timelimit_ms: typing.Optional[int],
+                    stats: typing.Optional[SearchStats] = None):
+        with SearchLimit(self.storage, timelimit_ms, self.max_expansions, stats) as limit:
+            return self._search(start_pos, end_pos, limit)
 
-            for neighbour in self.storage.get_pos_neighbours(current):
-                next_pos = neighbour.pos
-
-                #if next_pos != start_pos.get_pos(): #and not self.can_enter_tile(next_pos, game, direction,
-                                        #                        ignore_entities=ignore_entities):
-                #    continue
-
-                min_station_dist = self.storage.get_heuristic_distance_to_locations(current)
-                additional_cost = self.distance_between_points(current, next_pos)
-                if min_station_dist < self.heuristic_distance_threshold:
-                    additional_cost = 10
-                elif neighbour.connection is not None:
-                    if neighbour.connection.is_train:
-                        additional_cost /= 1000
-                    additional_cost += neighbour.connection.get_weight()
-                new_cost = costs.get(current) + additional_cost
-                if next_pos not in costs or new_cost < costs[next_pos]:
-                    costs[next_pos] = new_cost
-                    priority = new_cost + self.distance_between_points(next_pos, end_pos.get_pos())
-                    heapq.heappush(node_heap, (priority, next_pos))
-                    node_map[next_pos] = AStarPosition(current, neighbour.connection)
+    def _is_near_station(self, pos) -> bool:
+        min_station_dist = self.storage.get_heuristic_distance_to_locations(pos)
+        return min_station_dist is not None and min_station_dist < self.heuristic_distance_threshold
 
+    @staticmethod
+    def _make_path(graph: AdjacencyGraph, parents, parent_edges, end: int) -> [AStarPosition]:
         path = []
-        if end_pos.get_pos() not in node_map.keys():
-            return None, costs
-        current = node_map[end_pos.get_pos()]
-        while current is not None:
-            path.append(current)
-            current = node_map[current.pos]
+        current = end
+        while parents[current] is not None:
+            parent = parents[current]
+            edge = parent_edges.get(current)
+            path.append(AStarPosition(unpack_position(parent), graph.connections[edge] if edge is not None else None))
+            current = parent
         path.reverse()
+        return path
+
+    def _search(self, start_pos: Position, end_pos: Position, limit: SearchLimit):
+        graph = self.storage.get_adjacency_graph()
+        index_by_key, offsets, targets = graph.index_by_key, graph.offsets, graph.targets
+        edge_costs, packed_positions, positions = graph.costs, graph.packed_positions, graph.positions
+        end_x, end_y = end_pos.get_pos()
+        start = pack_position(start_pos.get_pos())
+        end = pack_position(end_pos.get_pos())
+
+        # positions are packed ints, AStarPosition objects are only made for the path that is returned
+        node_heap = [(0, start)]
+        costs = {
+            start: 0
+        }
+        parents = {
+            start: None
+        }
+        # edge of the adjacency graph a node was reached by, walked to nodes have none
+        parent_edges = {}
+        # cost each node was expanded at, later heap entries of the node at that cost have nothing new
+        expanded = {}
+        while node_heap:
+            current = heapq.heappop(node_heap)[1]
+            if current == end:
+                break
+            cost = costs[current]
+            if expanded.get(current) == cost:
+                continue
+            expanded[current] = cost
+            limit.expand(len(node_heap) + 1)
+
+            x, y = unpack_position(current)
+            is_near_station = self._is_near_station((x, y))
+            walk_cost = cost + (10 if is_near_station else 1)
+            for key_offset, offset_x, offset_y in self.neighbour_offsets:
+                next_key = current + key_offset
+                if next_key not in costs or walk_cost < costs[next_key]:
+                    costs[next_key] = walk_cost
+                    heapq.heappush(node_heap, (walk_cost + abs(end_x - x - offset_x) + abs(end_y - y - offset_y),
+                                               next_key))
+                    limit.push()
+                    parents[next_key] = current
+                    parent_edges.pop(next_key, None)
+
+            index = index_by_key.get(current)
+            if index is None:
+                continue
+            for edge in range(offsets[index], offsets[index + 1]):
+                next_index = targets[edge]
+                next_key = packed_positions[next_index]
+                new_cost = cost + (10 if is_near_station else edge_costs[edge])
+                if next_key not in costs or new_cost < costs[next_key]:
+                    costs[next_key] = new_cost
+                    next_x, next_y = positions[next_index]
+                    heapq.heappush(node_heap, (new_cost + abs(end_x - next_x) + abs(end_y - next_y), next_key))
+                    limit.push()
+                    parents[next_key] = current
+                    parent_edges[next_key] = edge
+
+        if end not in parents.keys():
+            return None, {}
+        return self._make_path(graph, parents, parent_edges, end), {end_pos.get_pos(): costs[end]}
 
-        return path, costs
+    @staticmethod
+    def get_connection_cost(a, b, connection):
+        return get_connection_cost(AStar.distance_between_points(a, b), connection.is_train, connection.get_weight())
 
     @staticmethod
     def distance_between_points(a, b):
@@ -0,0 +1,133 @@
+import threading
+import typing
+from array import array
+from typing import Tuple
+
+_PACK_OFFSET = 1 << 31
+
+
+def pack_position(pos: Tuple[int, int]) -> int:
+    """
+    One int for a position, x in the high and y in the low 32 bits. Moving by (dx, dy) adds dx << 32 + dy.
+    """
+    x, y = pos
+    return ((x + _PACK_OFFSET) << 32) + y + _PACK_OFFSET
+
+
+def unpack_position(key: int) -> Tuple[int, int]:
+    return (key >> 32) - _PACK_OFFSET, (key & 0xffffffff) - _PACK_OFFSET
+
+
+def get_connection_cost(length: int, is_train: bool, weight) -> float:
+    """
+    Cost of riding a connection of the given Manhattan length, trains cover distance almost for free
+    """
+    return (length / 1000 if is_train else length) + weight
+
+
+class AdjacencyGraph:
+    """
+    Connections between locations in compressed sparse row form. Locations have dense indices in the order of the
+    location list, the edges leaving location i are offsets[i] to offsets[i + 1] of the edge arrays. A snapshot is
+    never changed after it was built, searches holding one are not affected by a rebuild.
+    """
+    def __init__(self):
+        self.positions: [Tuple[int, int]] = []
+        self.index_by_pos: typing.Dict[Tuple[int, int], int] = {}
+        # the same for packed positions
+        self.packed_positions = array("Q")
+        self.index_by_key: typing.Dict[int, int] = {}
+        self.offsets = array("q", [0])
+        self.targets = array("l")
+        self.weights = array("d")
+        self.lengths = array("q")
+        self.is_train = array("b")
+        self.costs = array("d")
+        # index into line_labels, connections sharing a label are one line
+        self.line_ids = array("l")
+        self.line_labels: [str] = []
+        # only needed to describe the route once it is found
+        self.connections = []
+        # indices of the locations with at least one edge
+        self.connected_indices = array("l")
+
+    @staticmethod
+    def build(locations, get_line_id: typing.Callable[[str], int]) -> 'AdjacencyGraph':
+        graph = AdjacencyGraph()
+        for location in locations:
+            graph.index_by_pos[location.get_pos()] = len(graph.positions)
+            graph.index_by_key[pack_position(location.get_pos())] = len(graph.positions)
+            graph.packed_positions.append(pack_position(location.get_pos()))
+            graph.positions.append(location.get_pos())
+
+        for location in locations:
+            x, y = location.get_pos()
+            for connection in location.get_connections():
+                # same neighbour the searches got from the location itself
+                other_location = connection.get_other_side(location)
+                if other_location is None or other_location.get_pos() not in graph.index_by_pos.keys():
+                    continue
+                other_x, other_y = other_location.get_pos()
+                length = abs(other_x - x) + abs(other_y - y)
+                graph.targets.append(graph.index_by_pos[other_location.get_pos()])
+                graph.weights.append(connection.get_weight())
+                graph.lengths.append(length)
+                graph.is_train.append(1 if connection.get_is_train() else 0)
+                graph.costs.append(get_connection_cost(length, connection.get_is_train(), connection.get_weight()))
+                graph.line_ids.append(get_line_id(connection.get_label()))
+                graph.connections.append(connection)
+            if len(graph.targets) > graph.offsets[-1]:
+                graph.connected_indices.append(len(graph.offsets) - 1)
+            graph.offsets.append(len(graph.targets))
+        return graph
+
+    def get_index(self, pos: Tuple[int, int]) -> typing.Optional[int]:
+        return self.index_by_pos.get(pos)
+
+    def get_edge_range(self, index: int) -> range:
+        return range(self.offsets[index], self.offsets[index + 1])
+
+
+class Adjacency:
+    """
+    Owner of the adjacency graph of a storage, rebuilt on the first lookup after it was invalidated
+    """
+    def __init__(self, get_locations: typing.Callable[[], list]):
+        self.get_locations = get_locations
+        self.build_lock = threading.Lock()
+        self.graph: typing.Optional[AdjacencyGraph] = None
+        # bumped by every invalidation, a graph whose build raced a change is not kept
+        self.generation = 0
+        # line ids stay the same across rebuilds
+        self.line_ids: typing.Dict[str, int] = {}
+
+    def invalidate(self, *_):
+        self.generation += 1
+        self.graph = None
+
+    def _get_line_id(self, label: str) -> int:
+        if label not in self.line_ids.keys():
+            self.line_ids[label] = len(self.line_ids)
+        return self.line_ids[label]
+
+    def set_graph(self, graph: AdjacencyGraph, line_ids: typing.Dict[str, int]):
+        """
+        Use a graph built earlier for the same locations, e.g. one kept in a snapshot
+        """
+        with self.build_lock:
+            self.line_ids = line_ids
+            self.graph = graph
+
+    def get_graph(self) -> AdjacencyGraph:
+        graph = self.graph
+        if graph is not None:
+            return graph
+        with self.build_lock:
+            if self.graph is not None:
+                return self.graph
+            generation = self.generation
+            graph = AdjacencyGraph.build(self.get_locations(), self._get_line_id)
+            graph.line_labels = [label for label, _ in sorted(self.line_ids.items(), key=lambda item: item[1])]
+            if generation == self.generation:
+                self.graph = graph
+            return graph
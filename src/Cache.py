@@ -1,22 +1,125 @@
-import multiprocessing
-import mgzip
 import json
+import multiprocessing
+import struct
+import sys
 import typing
+from array import array
+from typing import Tuple
+
+
+class CacheException(Exception):
+    pass
+
+
+class CacheGrid:
+    # value of a cell that has nothing cached, e.g. there are no stations to measure a distance to
+    empty_value = -1
+
+    def __init__(self, min_x: int, min_y: int, width: int, height: int, values: typing.Optional[array] = None):
+        self.min_x = min_x
+        self.min_y = min_y
+        self.width = width
+        self.height = height
+        if values is None:
+            values = array("i", [CacheGrid.empty_value]) * (width * height)
+        elif len(values) != width * height:
+            raise CacheException("Cache grid of {}x{} has {} values".format(width, height, len(values)))
+        self.values = values
+
+    @staticmethod
+    def values_from_bytes(data: bytes) -> array:
+        values = array("i")
+        values.frombytes(data)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    @staticmethod
+    def values_to_bytes(values: array) -> bytes:
+        if sys.byteorder != "little":
+            values = array("i", values)
+            values.byteswap()
+        return values.tobytes()
+
+    def contains(self, pos: Tuple[int, int]) -> bool:
+        x, y = pos
+        return 0 <= x - self.min_x < self.width and 0 <= y - self.min_y < self.height
+
+    def get_value(self, pos: Tuple[int, int]) -> typing.Optional[int]:
+        x, y = pos
+        value = self.values[(y - self.min_y) * self.width + (x - self.min_x)]
+        return None if value == CacheGrid.empty_value else value
+
+    def set_value(self, pos: Tuple[int, int], value: typing.Optional[int]):
+        x, y = pos
+        self.values[(y - self.min_y) * self.width + (x - self.min_x)] = \
+            CacheGrid.empty_value if value is None else value
 
 
 class Cache:
+    # start of a cache file holding grids, older files are a single json document
+    _cls_file_magic = b"BRPCACHE"
+    _cls_file_version = 1
+
     def __init__(self):
         self.data = {}
+        self.grids: typing.Dict[str, typing.List[CacheGrid]] = {}
+        # lookups answered from the cache, per cache type
+        self.hits: typing.Dict[str, int] = {}
 
     def from_file(self, path):
+        import mgzip
+
         with open(path, "rb") as f:
-            with mgzip.open(f, "rt", thread=multiprocessing.cpu_count()) as gz:
-                self.data = json.load(gz)
+            with mgzip.open(f, "rb", thread=multiprocessing.cpu_count()) as gz:
+                contents = gz.read()
+
+        if not contents.startswith(Cache._cls_file_magic):
+            self.data = json.loads(contents.decode())
+            self.grids = {}
+            return
+
+        offset = len(Cache._cls_file_magic)
+        version, header_length = struct.unpack_from("<II", contents, offset)
+        if version != Cache._cls_file_version:
+            raise CacheException("Unknown cache file version {}".format(version))
+        offset += struct.calcsize("<II")
+        header = json.loads(contents[offset:offset + header_length].decode())
+        offset += header_length
+
+        self.data = header["data"]
+        self.grids = {}
+        for cache_type, grids in header["grids"].items():
+            for min_x, min_y, width, height in grids:
+                values = CacheGrid.values_from_bytes(contents[offset:offset + width * height * 4])
+                offset += width * height * 4
+                self.add_cached_grid(cache_type, CacheGrid(min_x, min_y, width, height, values))
+
+    def _get_memory_grids(self) -> typing.Dict[str, typing.List[CacheGrid]]:
+        # tile caches are kept in their own files
+        return {cache_type: [grid for grid in grids if isinstance(grid, CacheGrid)]
+                for cache_type, grids in self.grids.items()}
 
     def to_file(self, path):
+        memory_grids = self._get_memory_grids()
+        header = {
+            "data": self.data,
+            "grids": {
+                cache_type: [[grid.min_x, grid.min_y, grid.width, grid.height] for grid in grids]
+                for cache_type, grids in memory_grids.items()
+            }
+        }
+        header_data = json.dumps(header).encode()
+
+        import mgzip
         with open(path, "wb") as f:
-            with mgzip.open(f, "wt", thread=multiprocessing.cpu_count()) as gz:
-                json.dump(self.data, gz)
+            with mgzip.open(f, "wb", thread=multiprocessing.cpu_count()) as gz:
+                gz.write(Cache._cls_file_magic)
+                gz.write(struct.pack("<II", Cache._cls_file_version, len(header_data)))
+                gz.write(header_data)
+                for grids in memory_grids.values():
+                    for grid in grids:
+                        gz.write(CacheGrid.values_to_bytes(grid.values))
 
     def set_cached_value(self, cache_type: str, cache_key: str, cache_value):
         if cache_type not in self.data.keys():
@@ -26,4 +129,38 @@ class Cache:
     def get_cached_value(self, cache_type: str, cache_key: str) -> typing.Optional[typing.Any]:
         if cache_type not in self.data.keys() or cache_key not in self.data[cache_type].keys():
             return None
+        self._count_hit(cache_type)
         return self.data[cache_type][cache_key]
+
+    def _count_hit(self, cache_type: str):
+        self.hits[cache_type] = self.hits.get(cache_type, 0) + 1
+
+    def get_hits(self, cache_type: str) -> int:
+        return self.hits.get(cache_type, 0)
+
+    def has_cached_values(self, cache_type: str) -> bool:
+        return cache_type in self.data.keys()
+
+    def add_cached_grid(self, cache_type: str, grid):
+        """
+        :param grid: A CacheGrid or anything else with contains(pos) and get_value(pos), like a TileCacheFile
+        """
+        if cache_type not in self.grids.keys():
+            self.grids[cache_type] = []
+        self.grids[cache_type].append(grid)
+
+    def remove_cached_grid(self, cache_type: str, grid):
+        if cache_type in self.grids.keys() and grid in self.grids[cache_type]:
+            self.grids[cache_type].remove(grid)
+
+    def get_cached_grid_value(self, cache_type: str, pos: Tuple[int, int]) -> typing.Optional[int]:
+        if cache_type not in self.grids.keys():
+            return None
+        # grids added later cover older ones
+        for grid in reversed(self.grids[cache_type]):
+            if grid.contains(pos):
+                value = grid.get_value(pos)
+                if value is not None:
+                    self._count_hit(cache_type)
+                return value
+        return None
@@ -0,0 +1,193 @@
+import multiprocessing
+import typing
+from array import array
+from enum import Enum
+from multiprocessing import shared_memory
+from multiprocessing.pool import Pool
+from typing import Tuple
+
+from src.Cache import CacheGrid
+from src.TileCache import TileCacheFile
+
+# larger than any distance in the world, small enough that adding coordinates to it cannot overflow
+_UNREACHED = 1 << 40
+# seconds between progress reports while a batch of tiles is computed
+_PROGRESS_INTERVAL = 0.2
+
+
+class CacheBuildMethod(Enum):
+    Pool = "pool"
+    Vectorised = "vectorised"
+
+
+def _distance_transform_1d(values, axis):
+    """
+    min over j of values[j] + |i - j| along one axis, from a forward and a backward running minimum
+    """
+    import numpy as np
+
+    shape = [1, 1]
+    shape[axis] = values.shape[axis]
+    indices = np.arange(values.shape[axis], dtype=np.int64).reshape(shape)
+    forward = np.minimum.accumulate(values - indices, axis=axis) + indices
+    backward = np.flip(np.minimum.accumulate(np.flip(values + indices, axis=axis), axis=axis), axis=axis) - indices
+    return np.minimum(forward, backward)
+
+
+def compute_distance_tile(stations: [Tuple[int, int]], min_x: int, min_y: int, width: int, height: int):
+    """
+    Manhattan distance from every cell of a rectangle to the nearest station, as a (height, width) int32 array
+    with CacheGrid.empty_value when there are no stations
+    """
+    import numpy as np
+
+    if not stations:
+        return np.full((height, width), CacheGrid.empty_value, dtype=np.int32)
+
+    station_xs = np.array([x for x, _ in stations], dtype=np.int64)
+    station_ys = np.array([y for _, y in stations], dtype=np.int64)
+    # a station outside the rectangle is as far from every cell as the nearest border cell plus its distance to
+    # that cell, so it can be seeded there
+    clamped_xs = np.clip(station_xs, min_x, min_x + width - 1)
+    clamped_ys = np.clip(station_ys, min_y, min_y + height - 1)
+    offsets = np.abs(station_xs - clamped_xs) + np.abs(station_ys - clamped_ys)
+
+    distances = np.full((height, width), _UNREACHED, dtype=np.int64)
+    np.minimum.at(distances, (clamped_ys - min_y, clamped_xs - min_x), offsets)
+    distances = _distance_transform_1d(distances, 0)
+    distances = _distance_transform_1d(distances, 1)
+    return distances.astype(np.int32)
+
+
+def compute_distance_tile_per_cell(stations: [Tuple[int, int]], min_x: int, min_y: int, width: int, height: int):
+    grid = CacheGrid(min_x, min_y, width, height)
+    for y in range(min_y, min_y + height):
+        for x in range(min_x, min_x + width):
+            grid.set_value((x, y), min((abs(x - sx) + abs(y - sy) for sx, sy in stations), default=None))
+    return grid.values
+
+
+def _compute_tile(method, stations, min_x, min_y, tile_size) -> Tuple[bytes, int]:
+    """
+    :return: The values of a tile as they are stored and the largest of them
+    """
+    if method == CacheBuildMethod.Vectorised:
+        values = compute_distance_tile(stations, min_x, min_y, tile_size, tile_size)
+        return values.astype("<i4").tobytes(), int(values.max())
+    values = compute_distance_tile_per_cell(stations, min_x, min_y, tile_size, tile_size)
+    return CacheGrid.values_to_bytes(values), max(values)
+
+
+# state of a pool worker, set once by _init_worker
+_worker_stations: [Tuple[int, int]] = []
+_worker_output = None
+_worker_tiles_done = None
+
+
+def _init_worker(stations: array, output_name: str, tiles_done):
+    """
+    :param stations: x and y of every station after each other, sent to every worker once instead of with every job
+    :param output_name: Shared memory the workers write their tiles to, one slot per job of a batch
+    :param tiles_done: Shared counter of the tiles finished
+    """
+    global _worker_stations, _worker_output, _worker_tiles_done
+    _worker_stations = list(zip(stations[0::2], stations[1::2]))
+    _worker_output = shared_memory.SharedMemory(name=output_name)
+    _worker_tiles_done = tiles_done
+
+
+def _make_tile_job(job) -> Tuple[int, int, int]:
+    """
+    Compute a tile into its slot of the shared output
+    :return: Index, slot and largest value of the tile, the only data sent back
+    """
+    method, index, min_x, min_y, tile_size, slot = job
+    data, max_value = _compute_tile(method, _worker_stations, min_x, min_y, tile_size)
+    _worker_output.buf[slot * len(data):(slot + 1) * len(data)] = data
+    with _worker_tiles_done.get_lock():
+        _worker_tiles_done.value += 1
+    return index, slot, max_value
+
+
+def _tile_job_generator(tile_cache: TileCacheFile, indices: [int], method):
+    for index in indices:
+        min_x, min_y = tile_cache.get_tile_origin(index)
+        yield method, index, min_x, min_y, tile_cache.tile_size
+
+
+def _take(generator, count):
+    jobs = []
+    for job in generator:
+        jobs.append(job)
+        if len(jobs) >= count:
+            break
+    return jobs
+
+
+def _make_tiles_in_pool(tile_cache: TileCacheFile, jobs, stations: [Tuple[int, int]], tiles_done: int,
+                        max_threads: int, callback: typing.Callable[[int, int], None]):
+    """
+    Jobs and results are a few numbers each, the stations reach the workers once when they start and the tiles come
+    back through shared memory, so nothing but the computation grows with the size of a tile
+    """
+    batch_size = max_threads * 2
+    output = shared_memory.SharedMemory(create=True, size=batch_size * tile_cache.tile_bytes)
+    batch_tiles_done = multiprocessing.Value("q", 0)
+    try:
+        station_array = array("q", (coordinate for station in stations for coordinate in station))
+        with Pool(max_threads, _init_worker, (station_array, output.name, batch_tiles_done)) as pool:
+            batch = _take(jobs, batch_size)
+            while batch:
+                batch_tiles_done.value = 0
+                result = pool.map_async(_make_tile_job, [job + (slot,) for slot, job in enumerate(batch)])
+                reported = 0
+                while not result.ready():
+                    result.wait(_PROGRESS_INTERVAL)
+                    if batch_tiles_done.value != reported:
+                        reported = batch_tiles_done.value
+                        callback(tiles_done + reported, tile_cache.num_tiles)
+                # slots are reused by the next batch, every tile is on disk before it starts
+                for index, slot, max_value in result.get():
+                    tile_cache.write_tile(index, output.buf[slot * tile_cache.tile_bytes:
+                                                            (slot + 1) * tile_cache.tile_bytes], max_value)
+                tiles_done += len(batch)
+                callback(tiles_done, tile_cache.num_tiles)
+                batch = _take(jobs, batch_size)
+    finally:
+        output.close()
+        output.unlink()
+
+
+def make_tile_cache(stations: [Tuple[int, int]], path: str, min_x: int, max_x: int, min_y: int, max_y: int,
+                    tile_size: int, max_threads: int, method: CacheBuildMethod,
+                    callback: typing.Callable[[int, int], None]):
+    """
+    Build the tiles of a rectangle that are missing from the tile cache at path, writing each one as it finishes.
+    Tiles an earlier build computed for other stations are only recomputed where a changed station can be nearer
+    than their values, so moving one station costs the few tiles around it instead of a rebuild.
+    At most a few tiles per worker are in memory at once, whatever the size of the rectangle.
+    """
+    tile_cache = TileCacheFile.open_for_writing(path, tile_size, min_x, max_x, min_y, max_y, stations)
+    try:
+        indices = [index for index in range(tile_cache.num_tiles) if not tile_cache.has_tile(index)]
+        is_update = tile_cache.station_fingerprint != TileCacheFile.get_station_fingerprint(stations)
+        if is_update:
+            affected = tile_cache.get_affected_tiles(tile_cache.begin_update(stations))
+            indices = sorted(set(indices) | affected)
+
+        tiles_done = tile_cache.num_tiles - len(indices)
+        callback(tiles_done, tile_cache.num_tiles)
+        jobs = _tile_job_generator(tile_cache, indices, method)
+
+        if max_threads <= 1:
+            for _, index, tile_min_x, tile_min_y, _ in jobs:
+                tile_cache.write_tile(index, *_compute_tile(method, stations, tile_min_x, tile_min_y, tile_size))
+                tiles_done += 1
+                callback(tiles_done, tile_cache.num_tiles)
+        else:
+            _make_tiles_in_pool(tile_cache, jobs, stations, tiles_done, max_threads, callback)
+
+        if is_update:
+            tile_cache.end_update(stations)
+    finally:
+        tile_cache.close()
@@ -1,7 +1,9 @@
 import json
+import multiprocessing
 import os.path
 from enum import Enum
 
+from src.RoutePlanner import RoutePlannerEngine
 from src.StorageProvider import StorageProviderTypes
 
 
@@ -16,6 +18,7 @@ class ConfigKeys(Enum):
     NetworkInterfaceConfig = "network_interface"
     LoggerType = "logger_type"
     LoggerConfig = "logger_config"
+    RoutePlannerConfig = "route_planner"
 
 
 class ConfigDataKeys(Enum):
@@ -25,6 +28,15 @@ class ConfigDataKeys(Enum):
     WorldBorderDimensionsMaxY = "max_y"
     NetworkListenAddress = "address"
     NetworkListenPort = "port"
+    NetworkWorkerType = "worker_type"
+    NetworkWorkerCount = "workers"
+    NetworkMetricsPort = "metrics_port"
+    RoutePlannerEngine = "engine"
+    RouteCacheSize = "cache_size"
+    RouteCacheSnapDistance = "cache_snap_distance"
+    RouteCachePath = "cache_path"
+    RoutePlannerMaxExpansions = "max_expansions"
+    RoutePlannerLogStats = "log_stats"
 
 
 class Config:
@@ -32,7 +44,9 @@ class Config:
         self.data = {
             ConfigKeys.StorageProviderType: StorageProviderTypes.JsonStorage,
             ConfigKeys.StorageProviderConfig: {
-                "path": "./data.json"
+                "path": "./data.json",
+                # loaded instead of parsing data.json while that is unchanged, None always parses it
+                "snapshot_path": "./data.snapshot"
             },
             ConfigKeys.WorldBorderDimensions: {
                 ConfigDataKeys.WorldBorderDimensionsMinX: -10_000_000,
@@ -42,11 +56,33 @@ class Config:
             },
             ConfigKeys.NetworkInterfaceConfig: {
                 ConfigDataKeys.NetworkListenAddress: "127.0.0.1",
-                ConfigDataKeys.NetworkListenPort:    28_581
+                ConfigDataKeys.NetworkListenPort:    28_581,
+                # "thread" or "process", processes each load their own copy of the storage
+                ConfigDataKeys.NetworkWorkerType:    "thread",
+                ConfigDataKeys.NetworkWorkerCount:   multiprocessing.cpu_count(),
+                # local port serving the metrics as plain text, None does not serve them
+                ConfigDataKeys.NetworkMetricsPort:   None
             },
+            # "db" writes every entry as it is added, "db_batched" writes them in batches from a background thread
             ConfigKeys.LoggerType: "db",
             ConfigKeys.LoggerConfig: {
-                "db_path": "./log.db"
+                "db_path": "./log.db",
+                # older entries are removed at startup and every few thousand entries, None keeps them
+                "retention_days": 30,
+                "max_entries": 1_000_000
+            },
+            ConfigKeys.RoutePlannerConfig: {
+                ConfigDataKeys.RoutePlannerEngine:      RoutePlannerEngine.Grid,
+                # finished routes kept in memory, 0 turns the cache off
+                ConfigDataKeys.RouteCacheSize:          1024,
+                # endpoints this close to a location share its cache entries, None only reuses exact endpoints
+                ConfigDataKeys.RouteCacheSnapDistance:  None,
+                # where the cache is kept between runs, None does not keep it
+                ConfigDataKeys.RouteCachePath:          "./route_cache.json",
+                # searches expanding more nodes than this fail, None for no limit
+                ConfigDataKeys.RoutePlannerMaxExpansions: None,
+                # log the stats of every search
+                ConfigDataKeys.RoutePlannerLogStats:    False
             }
         }
 
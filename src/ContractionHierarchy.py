@@ -0,0 +1,422 @@
+import heapq
+import threading
+import typing
+
+from src.AStar import AStar, AStarPosition, SearchLimit, SearchStats
+from src.Location import Position
+from src.LocationGraph import LocationGraphSearch
+from src.Logger import LogEntry, LogLevel
+from src.StorageProvider import StorageProvider
+
+
+class ContractionHierarchyEdge:
+    def __init__(self, cost: float, connection, middle: typing.Optional[int]):
+        self.cost = cost
+        self.connection = connection
+        # contracted node this shortcut bypasses, None for an edge of the original graph
+        self.middle = middle
+
+
+class ContractionHierarchyGraph:
+    """
+    Nodes and edges of one build of a hierarchy, never changed after it was built so searches holding it are not
+    affected by a rebuild
+    """
+    # sign of the x and y offsets of the four quadrants around a position, axes belong to both of their quadrants
+    _cls_quadrants = ((1, 1), (-1, 1), (-1, -1), (1, -1))
+
+    def __init__(self, node_positions: [typing.Tuple[int, int]],
+                 edges: typing.Dict[typing.Tuple[int, int], ContractionHierarchyEdge],
+                 upward_edges: [[typing.Tuple[int, ContractionHierarchyEdge]]],
+                 tree: [typing.Tuple[int, int, int]]):
+        """
+        :param tree: Implicit k-d tree of (x, y, node), the middle entry of every range splits it on the axis of
+        its depth
+        """
+        self.node_positions = node_positions
+        self.edges = edges
+        self.upward_edges = upward_edges
+        self.tree = tree
+
+    @staticmethod
+    def make_tree(node_positions: [typing.Tuple[int, int]]) -> [typing.Tuple[int, int, int]]:
+        tree = [(x, y, node) for node, (x, y) in enumerate(node_positions)]
+        ranges = [(0, len(tree), 0)]
+        while ranges:
+            begin, end, axis = ranges.pop()
+            if end - begin <= 1:
+                continue
+            tree[begin:end] = sorted(tree[begin:end], key=lambda entry: entry[axis])
+            middle = (begin + end) // 2
+            ranges.append((begin, middle, 1 - axis))
+            ranges.append((middle + 1, end, 1 - axis))
+        return tree
+
+    def get_walk_neighbours(self, pos: typing.Tuple[int, int], exclude_node: typing.Optional[int] = None) \
+            -> [typing.Tuple[int, int]]:
+        """
+        Nodes a walk from pos reaches without passing another node's block range. Every other node lies in the
+        bounding box of pos and one of these, walking via that one costs the same, so walks to these are enough
+        to reach any node at its Manhattan distance.
+        :return: (node, walk cost) of the nearest nodes of every quadrant that are not behind a nearer one, only the
+        node at pos if there is one
+        """
+        tree = self.tree
+        node_positions = self.node_positions
+        if not tree:
+            return []
+
+        x, y = pos
+        # offsets of the nodes found so far in every quadrant, one dominating another makes the other a detour
+        found = [[] for _ in ContractionHierarchyGraph._cls_quadrants]
+        neighbours = []
+        # ranges by the lower bound of their distance, (bound, begin, end, axis, min x, max x, min y, max y), and
+        # nodes by their distance, (distance, -1, node), so nodes are found nearest first and never dominate an
+        # earlier one
+        heap = [(0, 0, len(tree), 0, None, None, None, None)]
+        while heap:
+            item = heapq.heappop(heap)
+            if item[1] < 0:
+                distance, _, node = item
+                dx, dy = node_positions[node][0] - x, node_positions[node][1] - y
+                if distance == 0:
+                    # walking anywhere via the node at pos costs the same
+                    return [(node, 0)]
+                is_neighbour = False
+                for quadrant, (sign_x, sign_y) in enumerate(ContractionHierarchyGraph._cls_quadrants):
+                    a, b = sign_x * dx, sign_y * dy
+                    if a >= 0 and b >= 0 and not self._is_dominated(found[quadrant], a, b):
+                        found[quadrant].append((a, b))
+                        is_neighbour = True
+                if is_neighbour:
+                    neighbours.append((node, distance))
+                continue
+
+            _, begin, end, axis, min_x, max_x, min_y, max_y = item
+            if not self._is_range_useful(found, x, y, min_x, max_x, min_y, max_y):
+                continue
+            middle = (begin + end) // 2
+            entry_x, entry_y, node = tree[middle]
+            if node != exclude_node:
+                heapq.heappush(heap, (abs(entry_x - x) + abs(entry_y - y), -1, node))
+
+            split = entry_x if axis == 0 else entry_y
+            for child_begin, child_end, is_upper in ((begin, middle, False), (middle + 1, end, True)):
+                if child_begin >= child_end:
+                    continue
+                child = [min_x, max_x, min_y, max_y]
+                # the upper half is at or above the split, the lower half at or below
+                child[axis * 2 + (0 if is_upper else 1)] = split
+                child_min_x, child_max_x, child_min_y, child_max_y = child
+                bound = (max(0, child_min_x - x if child_min_x is not None else 0,
+                             x - child_max_x if child_max_x is not None else 0) +
+                         max(0, child_min_y - y if child_min_y is not None else 0,
+                             y - child_max_y if child_max_y is not None else 0))
+                heapq.heappush(heap, (bound, child_begin, child_end, 1 - axis, *child))
+        return neighbours
+
+    @staticmethod
+    def _is_dominated(found, a, b) -> bool:
+        return any(a >= other_a and b >= other_b for other_a, other_b in found)
+
+    @staticmethod
+    def _is_range_useful(found, x, y, min_x, max_x, min_y, max_y) -> bool:
+        for quadrant, (sign_x, sign_y) in enumerate(ContractionHierarchyGraph._cls_quadrants):
+            # smallest offsets of the range within the quadrant, None is unbounded
+            low_x, high_x = (min_x, max_x) if sign_x > 0 else (max_x, min_x)
+            low_y, high_y = (min_y, max_y) if sign_y > 0 else (max_y, min_y)
+            if high_x is not None and sign_x * (high_x - x) < 0:
+                continue
+            if high_y is not None and sign_y * (high_y - y) < 0:
+                continue
+            a = max(0, sign_x * (low_x - x)) if low_x is not None else 0
+            b = max(0, sign_y * (low_y - y)) if low_y is not None else 0
+            if not ContractionHierarchyGraph._is_dominated(found[quadrant], a, b):
+                return True
+        return False
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy over the locations that have connections. Riding a connection and walking to the
+    locations that get_walk_neighbours returns are the edges of the graph, walks are costed by their Manhattan
+    distance like the location graph does. The hierarchy is built on a background thread after the storage reports
+    a change, queries are answered by a location graph search until it is done.
+    """
+    def __init__(self, storage: StorageProvider, max_expansions: typing.Optional[int] = None,
+                 witness_settle_limit: int = 64, core_degree: int = 24):
+        """
+        :param core_degree: Nodes that have more edges than this when they are due are left uncontracted
+        """
+        self.storage = storage
+        self.max_expansions = max_expansions
+        self.witness_settle_limit = witness_settle_limit
+        self.core_degree = core_degree
+        self.fallback = LocationGraphSearch(storage, max_expansions)
+        self.condition = threading.Condition()
+        # (generation, graph) of the last build that no change raced
+        self.built: typing.Optional[typing.Tuple[int, ContractionHierarchyGraph]] = None
+        # bumped by every invalidation, a hierarchy whose build raced a change is not kept
+        self.generation = 0
+        self.build_requested = True
+        self.build_error: typing.Optional[Exception] = None
+        self.builder_thread = threading.Thread(target=self._build_loop, name="ContractionHierarchy", daemon=True)
+        self.builder_thread.start()
+
+        storage.add_change_listener(self.invalidate)
+
+    def invalidate(self):
+        with self.condition:
+            self.generation += 1
+            self.build_requested = True
+            self.condition.notify_all()
+
+    def _build_loop(self):
+        while True:
+            with self.condition:
+                while not self.build_requested:
+                    self.condition.wait()
+                self.build_requested = False
+                generation = self.generation
+
+            try:
+                graph = self.build()
+            except Exception as e:
+                # queries keep using the location graph, the next change requests another build. The error is
+                # logged by the next query, a DbLogger can only be used from the thread that opened it.
+                self.build_error = e
+                continue
+
+            with self.condition:
+                self.build_error = None
+                if generation == self.generation:
+                    self.built = (generation, graph)
+                    self.condition.notify_all()
+
+    def wait_until_built(self, timeout: typing.Optional[float] = None) -> bool:
+        """
+        :param timeout: Seconds to wait, None waits until the hierarchy is built
+        :return: Whether the hierarchy of the current locations and connections is built
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.get_graph() is not None, timeout)
+
+    def get_graph(self) -> typing.Optional[ContractionHierarchyGraph]:
+        """
+        :return: Hierarchy of the current locations and connections, None while it is being built
+        """
+        built = self.built
+        if built is None or built[0] != self.generation:
+            return None
+        return built[1]
+
+    @staticmethod
+    def _edge_key(u, v):
+        return (u, v) if u < v else (v, u)
+
+    def _make_base_graph(self):
+        """
+        :return: Position and edges of every node and the tree of their positions
+        """
+        graph = self.storage.get_adjacency_graph()
+        # node of every position of a location that has a connection
+        node_ids = {}
+        for index in graph.connected_indices:
+            node_ids.setdefault(graph.positions[index], len(node_ids))
+        node_positions = list(node_ids.keys())
+        tree = ContractionHierarchyGraph.make_tree(node_positions)
+        lookup = ContractionHierarchyGraph(node_positions, {}, [], tree)
+
+        adjacency = [{} for _ in node_positions]
+        for u, u_pos in enumerate(node_positions):
+            for v, cost in lookup.get_walk_neighbours(u_pos, u):
+                adjacency[u][v] = adjacency[v][u] = ContractionHierarchyEdge(cost, None, None)
+
+        for index in graph.connected_indices:
+            u = node_ids[graph.positions[index]]
+            for edge in graph.get_edge_range(index):
+                v = node_ids[graph.positions[graph.targets[edge]]]
+                cost = graph.costs[edge]
+                if u != v and (v not in adjacency[u] or cost < adjacency[u][v].cost):
+                    adjacency[u][v] = adjacency[v][u] = ContractionHierarchyEdge(cost, graph.connections[edge], None)
+
+        return node_positions, adjacency, tree
+
+    def _get_witness_costs(self, adjacency, source, targets, skip, max_cost):
+        """
+        :return: Costs of paths from source that avoid skip, a search stopped by the settle limit leaves some
+        too high but never too low
+        """
+        costs = {source: 0}
+        node_heap = [(0, source)]
+        remaining = len(targets)
+        settled = 0
+        while node_heap and settled < self.witness_settle_limit:
+            cost, current = heapq.heappop(node_heap)
+            if cost > costs[current]:
+                continue
+            if current in targets:
+                remaining -= 1
+                if remaining == 0:
+                    break
+            settled += 1
+            for next_node, edge in adjacency[current].items():
+                if next_node == skip:
+                    continue
+                new_cost = cost + edge.cost
+                if new_cost <= max_cost and (next_node not in costs or new_cost < costs[next_node]):
+                    costs[next_node] = new_cost
+                    heapq.heappush(node_heap, (new_cost, next_node))
+        return costs
+
+    def _get_shortcuts(self, adjacency, node):
+        neighbours = list(adjacency[node].items())
+        shortcuts = []
+        # one search from every neighbour covers its paths to all the later ones
+        for i, (u, u_edge) in enumerate(neighbours[:-1]):
+            targets = neighbours[i + 1:]
+            costs = self._get_witness_costs(adjacency, u, {w for w, _ in targets}, node,
+                                            u_edge.cost + max(w_edge.cost for _, w_edge in targets))
+            for w, w_edge in targets:
+                cost = u_edge.cost + w_edge.cost
+                if w not in costs or costs[w] > cost:
+                    shortcuts.append((u, w, cost))
+        return shortcuts
+
+    def build(self) -> ContractionHierarchyGraph:
+        node_positions, adjacency, tree = self._make_base_graph()
+        num_nodes = len(node_positions)
+        # contracting the neighbours of contracted nodes later spreads the contraction evenly over the map
+        contracted_neighbours = [0] * num_nodes
+        edges = {}
+        upward_edges = [[] for _ in range(num_nodes)]
+
+        def get_priority(v):
+            shortcuts = self._get_shortcuts(adjacency, v)
+            return len(shortcuts) - len(adjacency[v]) + contracted_neighbours[v], shortcuts
+
+        # lazy updates, a node is only contracted once its re-evaluated priority is still the smallest
+        node_heap = [(get_priority(v)[0], v) for v in range(num_nodes)]
+        heapq.heapify(node_heap)
+        core = []
+        while node_heap:
+            _, node = heapq.heappop(node_heap)
+            if len(adjacency[node]) > self.core_degree:
+                # witness searches around nodes with this many edges take most of the build, the nodes left
+                # in the core are searched like a plain graph instead
+                core.append(node)
+                continue
+            priority, shortcuts = get_priority(node)
+            if node_heap and priority > node_heap[0][0]:
+                heapq.heappush(node_heap, (priority, node))
+                continue
+            # the remaining neighbours are contracted later, so every edge left is an upward one
+            for v, edge in adjacency[node].items():
+                edges[self._edge_key(node, v)] = edge
+                upward_edges[node].append((v, edge))
+                del adjacency[v][node]
+                contracted_neighbours[v] += 1
+            adjacency[node] = None
+            for u, w, cost in shortcuts:
+                adjacency[u][w] = adjacency[w][u] = ContractionHierarchyEdge(cost, None, node)
+
+        # core nodes are above every contracted node, so an upward search continues along all of their edges
+        for node in core:
+            for v, edge in adjacency[node].items():
+                edges[self._edge_key(node, v)] = edge
+                upward_edges[node].append((v, edge))
+
+        return ContractionHierarchyGraph(node_positions, edges, upward_edges, tree)
+
+    def _unpack_edge(self, graph: ContractionHierarchyGraph, u, v, segments):
+        edge = graph.edges[self._edge_key(u, v)]
+        if edge.middle is None:
+            segments.append((u, edge.connection))
+        else:
+            self._unpack_edge(graph, u, edge.middle, segments)
+            self._unpack_edge(graph, edge.middle, v, segments)
+
+    @staticmethod
+    def _upward_search(graph: ContractionHierarchyGraph, costs, parents, other_costs, node_heap, best,
+                       limit: SearchLimit):
+        cost, current = heapq.heappop(node_heap)
+        if cost > costs[current]:
+            return best
+        limit.expand(len(node_heap) + 1)
+        if current in other_costs.keys() and cost + other_costs[current] < best[0]:
+            best = (cost + other_costs[current], current)
+        for next_node, edge in graph.upward_edges[current]:
+            new_cost = cost + edge.cost
+            if next_node not in costs or new_cost < costs[next_node]:
+                costs[next_node] = new_cost
+                parents[next_node] = current
+                heapq.heappush(node_heap, (new_cost, next_node))
+                limit.push()
+        return best
+
+    def get_path_to(self, start_pos: Position, end_pos: Position, timelimit_ms: typing.Optional[int],
+                    stats: typing.Optional[SearchStats] = None):
+        graph = self.get_graph()
+        if graph is None:
+            error = self.build_error
+            if error is not None:
+                self.build_error = None
+                self.storage.get_logger().add_entry(LogEntry.create(
+                    LogLevel.Error, "Cannot build the contraction hierarchy: {}".format(error)))
+            # a build takes seconds on large maps, the request does not wait for it
+            return self.fallback.get_path_to(start_pos, end_pos, timelimit_ms, stats)
+        with SearchLimit(self.storage, timelimit_ms, self.max_expansions, stats) as limit:
+            return self._search(graph, start_pos, end_pos, limit)
+
+    def _search(self, graph: ContractionHierarchyGraph, start_pos: Position, end_pos: Position, limit: SearchLimit):
+        start = start_pos.get_pos()
+        end = end_pos.get_pos()
+
+        # walks from the start to the nodes around it reach every node at its Manhattan distance
+        forward_costs = dict(graph.get_walk_neighbours(start))
+        backward_costs = dict(graph.get_walk_neighbours(end))
+        forward_parents = {v: None for v in forward_costs.keys()}
+        backward_parents = {v: None for v in backward_costs.keys()}
+        forward_heap = [(cost, v) for v, cost in forward_costs.items()]
+        backward_heap = [(cost, v) for v, cost in backward_costs.items()]
+        heapq.heapify(forward_heap)
+        heapq.heapify(backward_heap)
+
+        # (cost, meeting node), None meets nowhere and walks straight to the end
+        best = (AStar.distance_between_points(start, end), None)
+        while (forward_heap and forward_heap[0][0] < best[0]) or (backward_heap and backward_heap[0][0] < best[0]):
+            if forward_heap and forward_heap[0][0] < best[0]:
+                best = self._upward_search(graph, forward_costs, forward_parents, backward_costs, forward_heap,
+                                           best, limit)
+            if backward_heap and backward_heap[0][0] < best[0]:
+                best = self._upward_search(graph, backward_costs, backward_parents, forward_costs,
+                                           backward_heap, best, limit)
+
+        best_cost, meeting_node = best
+        path = []
+        if meeting_node is None:
+            path.append(AStarPosition(start, None))
+        else:
+            up_nodes = [meeting_node]
+            while forward_parents[up_nodes[-1]] is not None:
+                up_nodes.append(forward_parents[up_nodes[-1]])
+            up_nodes.reverse()
+            down_nodes = [meeting_node]
+            while backward_parents[down_nodes[-1]] is not None:
+                down_nodes.append(backward_parents[down_nodes[-1]])
+
+            segments = []
+            nodes = up_nodes + down_nodes[1:]
+            for u, v in zip(nodes, nodes[1:]):
+                self._unpack_edge(graph, u, v, segments)
+            segments.append((nodes[-1], None))
+
+            if graph.node_positions[nodes[0]] != start:
+                path.append(AStarPosition(start, None))
+            for node, connection in segments:
+                path.append(AStarPosition(graph.node_positions[node], connection))
+        if path[-1].pos != end:
+            path.append(AStarPosition(end, None))
+
+        return path, {end: best_cost}
+
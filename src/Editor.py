@@ -4,15 +4,17 @@ import sys
 import typing
 
 from PySide6 import QtCore
-from PySide6.QtCore import QPoint, QThread, QObject
+from PySide6.QtCore import QPoint, QThread, QObject, QTimer, QSortFilterProxyModel, QModelIndex
 from PySide6.QtGui import Qt, QIcon, QAction, QCursor
-from PySide6.QtWidgets import QApplication, QMainWindow, QTreeWidgetItem, QWidget, QListWidgetItem, QDialog, QMenu, \
+from PySide6.QtWidgets import QApplication, QMainWindow, QWidget, QListWidgetItem, QDialog, QMenu, \
     QMessageBox
 
 from src.Config import Config, ConfigKeys, ConfigDataKeys
 from src.Connection import Connection
 from src.Location import Location
+from src.Logger import LogLevel
 from src.StorageProvider import StorageProvider
+from src.StorageTreeModel import StorageTreeModel
 from src.ui_mainwindow import Ui_MainWindow
 from src.ui_editor_sidewindow import Ui_Form as EditorSideWindowForm
 from src.ui_editor_connection import Ui_Form as EditorConnectionForm
@@ -34,13 +36,17 @@ class CacheThreadWorker(QObject):
         self.threads = threads
 
     def run(self):
-        total_num = (self.max_x - self.min_x) * (self.max_y - self.min_y)
         self.storage.make_cache(self.min_x, self.max_x, self.min_y, self.max_y, self.threads,
-                                lambda v: self.progress.emit(v, total_num))
+                                lambda tiles_done, tiles_total: self.progress.emit(tiles_done, tiles_total))
         self.finished.emit()
 
 
 class MainWindow(QMainWindow):
+    # sidebar edits are applied once typing pauses for this long
+    _cls_edit_debounce_ms = 300
+    # log entries the log viewer loads at a time, the next page once it is scrolled near the end
+    _cls_log_page_size = 200
+
     def __init__(self, app, storage: StorageProvider, config: Config):
         super().__init__()
         self.app = app
@@ -63,6 +69,18 @@ class MainWindow(QMainWindow):
         self.cache_thread = None
         self.log_form = None
         self.ui_log_form_modal = None
+        self.log_last_entry_id = None
+        self.log_is_complete = False
+
+        self.storage_model = StorageTreeModel(self.storage, self.cra_icon, self)
+        self.storage_proxy_model = QSortFilterProxyModel(self)
+        self.storage_proxy_model.setSourceModel(self.storage_model)
+        self.ui.storageView.setModel(self.storage_proxy_model)
+        self.ui.storageView.sortByColumn(0, Qt.AscendingOrder)
+
+        self.location_edit_timer = QTimer(self)
+        self.location_edit_timer.setSingleShot(True)
+        self.location_edit_timer.setInterval(MainWindow._cls_edit_debounce_ms)
 
         self.setWindowIcon(self.cra_icon)
         self.setup_signals()
@@ -75,49 +93,27 @@ class MainWindow(QMainWindow):
         self.ui.actionBuild_Cache.triggered.connect(self.on_build_cache)
         self.ui.actionSave.triggered.connect(self.on_save)
         self.ui.actionView_Log.triggered.connect(self.on_view_log)
+        self.ui.storageView.activated.connect(self.on_storage_view_item_activated)
+        self.location_edit_timer.timeout.connect(self.apply_location_edit)
 
     def init_storage_view(self):
         self.update_title()
-        self.ui.storageView.clear()
-
-        locations = self.storage.get_locations()
-        locations_item = QTreeWidgetItem()
-        locations_item.setText(0, "Locations")
-        for location in locations:
-            location_item = QTreeWidgetItem()
-            location_item.setText(0, "{} {}".format(location.get_label(), location.get_pos()))
-            location_item.setData(0, Qt.UserRole, location)
-            locations_item.addChild(location_item)
-        self.ui.storageView.addTopLevelItem(locations_item)
-
-        connections = self.storage.get_connections()
-        connections_item = QTreeWidgetItem()
-        connections_item.setText(0, "Connections")
-        for connection in connections:
-            connection_item = QTreeWidgetItem()
-            location_text = [x.get_label() for x in connection.get_locations()]
-            connection_item.setText(0, "{} and {}".format(location_text[0], location_text[1]))
-            connection_item.setData(0, Qt.UserRole, connection)
-            if connection.get_is_train():
-                connection_item.setIcon(0, self.cra_icon)
-            connections_item.addChild(connection_item)
-        self.ui.storageView.addTopLevelItem(connections_item)
-
+        self.storage_model.reload()
         self.ui.storageView.expandAll()
-        self.ui.storageView.itemActivated.connect(self.on_storage_view_item_activated)
 
     def update_title(self):
         self.setWindowTitle("{} {}".format(self.window_title, "*" if self.save_required else ""))
 
     def on_save(self):
+        self.flush_location_edit()
         if self.save_required:
             self.storage.save()
             self.save_required = False
             self.update_title()
             self.ui.statusbar.showMessage("Saved Successfully", 5000)
 
-    def on_storage_view_item_activated(self, item: QTreeWidgetItem, _):
-        data = item.data(0, Qt.UserRole)
+    def on_storage_view_item_activated(self, index: QModelIndex):
+        data = index.data(Qt.UserRole)
         if isinstance(data, Location):
             self.load_location_sidebar(data)
         elif isinstance(data, Connection):
@@ -126,6 +122,8 @@ class MainWindow(QMainWindow):
             pass
 
     def load_location_sidebar(self, location: Location):
+        # a pending edit belongs to the form about to be replaced
+        self.flush_location_edit()
         if self.current_editing_location_id != location.get_id():
             pass
         self.ui_form = EditorSideWindowForm()
@@ -173,40 +171,50 @@ class MainWindow(QMainWindow):
             self.ui_form.connections_list.addItem(item)
         self.ui_form.connections_list.itemActivated.connect(self.on_connection_activated_edit)
 
-    def on_location_id_change(self, text):
-        self.save_required = True
-        location = self.storage.get_location_by_id(self.current_editing_location_id)
-        location.set_id(text)
-        self.storage.update_location(location)
+    def on_location_id_change(self, _):
+        self.location_edit_timer.start()
 
-        self.init_storage_view()
-        self.current_editing_location_id = location.get_id()
+    def on_location_label_change(self, _):
+        self.location_edit_timer.start()
 
-    def on_location_label_change(self, text):
-        self.save_required = True
-        location = self.storage.get_location_by_id(self.current_editing_location_id)
-        location.set_label(text)
-        self.storage.update_location(location)
+    def on_location_x_change(self, _):
+        self.location_edit_timer.start()
 
-        self.init_storage_view()
+    def on_location_y_change(self, _):
+        self.location_edit_timer.start()
 
-    def on_location_x_change(self, value):
-        self.save_required = True
-        location = self.storage.get_location_by_id(self.current_editing_location_id)
-        pos = (value, location.get_pos()[1])
-        location.set_pos(pos)
-        self.storage.update_location(location)
+    def flush_location_edit(self):
+        if self.location_edit_timer.isActive():
+            self.location_edit_timer.stop()
+            self.apply_location_edit()
 
-        self.init_storage_view()
+    def apply_location_edit(self):
+        """
+        Write the sidebar fields to the location being edited, once per pause in typing rather than per keystroke
+        """
+        if self.current_editing_location_id is None or self.ui_form is None:
+            return
+        location = self.storage.get_location_by_id(self.current_editing_location_id)
+        if location is None:
+            return
+        location_id = self.ui_form.id_edit.text()
+        label = self.ui_form.label_edit.text()
+        pos = (self.ui_form.x_edit.value(), self.ui_form.y_edit.value())
+        if location_id == location.get_id() and label == location.get_label() and pos == location.get_pos():
+            return
 
-    def on_location_y_change(self, value):
         self.save_required = True
-        location = self.storage.get_location_by_id(self.current_editing_location_id)
-        pos = (location.get_pos()[0], value)
-        location.set_pos(pos)
+        if location_id != location.get_id():
+            location.set_id(location_id)
+        if label != location.get_label():
+            location.set_label(label)
+        if pos != location.get_pos():
+            location.set_pos(pos)
         self.storage.update_location(location)
 
-        self.init_storage_view()
+        self.current_editing_location_id = location.get_id()
+        self.storage_model.update_location(location)
+        self.update_title()
 
     @staticmethod
     def make_random_id(length=5):
@@ -228,11 +236,13 @@ class MainWindow(QMainWindow):
         random_id = self.make_random_id()
         location = Location(random_id, random_id, 0, 0, None)
         self.storage.add_location(location)
-        self.init_storage_view()
+        self.storage_model.add_item(location)
+        self.update_title()
         self.load_location_sidebar(location)
         self.current_editing_location_id = location.get_id()
 
     def on_add_connection(self):
+        self.flush_location_edit()
         if self.current_editing_location_id is None:
             return
 
@@ -321,7 +331,8 @@ class MainWindow(QMainWindow):
         connection.add_location(location_2)
         self.storage.add_connection(connection)
 
-        self.init_storage_view()
+        self.storage_model.add_item(connection)
+        self.update_title()
         self.load_location_sidebar(self.storage.get_location_by_id(self.current_editing_location_id))
         self.connection_form_modal = None
         self.connection_form_modal_dialog.close()
@@ -333,6 +344,7 @@ class MainWindow(QMainWindow):
         self.connection_form_modal_dialog = None
 
     def on_connection_activated_edit(self, item: QListWidgetItem):
+        self.flush_location_edit()
         connection = item.data(Qt.UserRole)
         location = self.storage.get_location_by_id(self.current_editing_location_id)
         self.current_editing_connection = connection
@@ -365,7 +377,8 @@ class MainWindow(QMainWindow):
 
         connection.set_description(self.connection_form_modal.edit_description.toPlainText())
 
-        self.init_storage_view()
+        self.storage_model.update_item(connection)
+        self.update_title()
         self.load_location_sidebar(self.storage.get_location_by_id(self.current_editing_location_id))
         self.connection_form_modal = None
         self.connection_form_modal_dialog.close()
@@ -392,7 +405,8 @@ class MainWindow(QMainWindow):
         if message_box.exec_() == QMessageBox.Yes:
             self.save_required = True
             self.storage.delete_connection(self.current_editing_connection)
-            self.init_storage_view()
+            self.storage_model.remove_item(self.current_editing_connection)
+            self.update_title()
             self.load_location_sidebar(self.storage.get_location_by_id(self.current_editing_location_id))
             self.on_edit_connection_modal_cancel()
             self.ui.statusbar.showMessage("Deleted connection between {} and {} via {}".format(
@@ -400,6 +414,7 @@ class MainWindow(QMainWindow):
             ), 5000)
 
     def on_sidebar_delete(self):
+        self.flush_location_edit()
         message_box = QMessageBox()
         message_box.setWindowTitle("Confirm delete location")
         message_box.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
@@ -411,8 +426,13 @@ class MainWindow(QMainWindow):
         ))
         if message_box.exec_() == QMessageBox.Yes:
             self.save_required = True
+            # the storage drops the connections of the location along with it
+            connections = list(location.get_connections())
             self.storage.delete_location(location)
-            self.init_storage_view()
+            for connection in connections:
+                self.storage_model.remove_item(connection)
+            self.storage_model.remove_item(location)
+            self.update_title()
             self.clear_location_sidebar()
             self.ui.statusbar.showMessage("Deleted location {} and {} connections".format(
                 location.get_label(), num_connections
@@ -424,16 +444,12 @@ class MainWindow(QMainWindow):
         widget = QWidget()
         log_form.setupUi(widget)
 
-        logger = self.storage.get_logger()
-
-        current_entry_id = None
-        first = True
-        while current_entry_id is not None or first:
-            entry = logger.get_next_entry(current_entry_id)
-            if entry is None:
-                break
-            current_entry_id = entry.get_id()
-            self.log_form.log_list.addItem(QListWidgetItem(logger.format_log_entry(entry)))
+        log_form.level_filter.addItem("All", userData=None)
+        for level in LogLevel:
+            log_form.level_filter.addItem(level.name, userData=level)
+        log_form.level_filter.currentIndexChanged.connect(self.on_log_level_filter_change)
+        log_form.log_list.verticalScrollBar().valueChanged.connect(self.on_log_scrolled)
+        self.reload_log()
 
         dialog = QDialog()
         self.ui_log_form_modal = dialog
@@ -444,6 +460,31 @@ class MainWindow(QMainWindow):
         dialog.show()
         dialog.exec_()
 
+    def reload_log(self):
+        self.log_form.log_list.clear()
+        # a scroll bar left at the end would not signal the next scroll down
+        self.log_form.log_list.scrollToTop()
+        self.log_last_entry_id = None
+        self.log_is_complete = False
+        self.load_log_page()
+
+    def load_log_page(self):
+        logger = self.storage.get_logger()
+        min_level = self.log_form.level_filter.currentData()
+        entries = logger.get_entry_range(self.log_last_entry_id, None, MainWindow._cls_log_page_size, min_level)
+        if entries:
+            self.log_last_entry_id = entries[-1].get_id()
+        self.log_is_complete = len(entries) < MainWindow._cls_log_page_size
+        self.log_form.log_list.addItems([logger.format_log_entry(entry) for entry in entries])
+
+    def on_log_level_filter_change(self, _):
+        self.reload_log()
+
+    def on_log_scrolled(self, value):
+        scroll_bar = self.log_form.log_list.verticalScrollBar()
+        if not self.log_is_complete and value >= scroll_bar.maximum() - scroll_bar.pageStep():
+            self.load_log_page()
+
     def on_build_cache(self):
         cache_form = EditorCacheForm()
         self.ui_cache_modal = cache_form
@@ -505,9 +546,9 @@ class MainWindow(QMainWindow):
         self.ui_cache_modal = None
         self.cache_worker = None
 
-    def update_percent_bar(self, v, total_num):
-        self.ui_cache_modal.progressBar.setValue(v // total_num * 100)
-        self.ui_cache_modal.progress_text.setText("{} / {}".format(v, total_num))
+    def update_percent_bar(self, tiles_done, tiles_total):
+        self.ui_cache_modal.progressBar.setValue(tiles_done * 100 // tiles_total)
+        self.ui_cache_modal.progress_text.setText("{} / {} tiles".format(tiles_done, tiles_total))
 
 
 class EditorApplication:
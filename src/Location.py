@@ -39,6 +39,7 @@ class Location(Position):
 
         self.is_station = False
         self.connections = []
+        self.station_listener: typing.Optional[typing.Callable[['Location'], None]] = None
 
     def get_id(self):
         return self.id
@@ -53,21 +54,29 @@ class Location(Position):
         self.prev_id = self.id
         self.id = location_id
 
+    def __getstate__(self):
+        # the listener belongs to the storage holding the location, it is set again when one loads it
+        state = self.__dict__.copy()
+        state["station_listener"] = None
+        return state
+
+    def set_station_listener(self, listener: typing.Optional[typing.Callable[['Location'], None]]):
+        self.station_listener = listener
+
     def add_connection(self, connection: Connection):
         self.connections.append(connection)
-        if connection.is_train:
-            self.is_station = True
+        self.update_is_station()
 
     def remove_connection(self, connection: Connection):
         self.connections.remove(connection)
-        self.is_station = False
         self.update_is_station()
 
     def update_is_station(self):
-        for connection in self.connections:
-            if connection.is_train:
-                self.is_station = True
-                break
+        is_station = any(connection.is_train for connection in self.connections)
+        if is_station != self.is_station:
+            self.is_station = is_station
+            if self.station_listener is not None:
+                self.station_listener(self)
 
     def get_label(self):
         return self.label
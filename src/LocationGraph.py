@@ -0,0 +1,95 @@
+import heapq
+import typing
+
+from src.AStar import AStar, AStarPosition, SearchLimit, SearchStats
+from src.Location import Position
+from src.StorageProvider import StorageProvider
+
+
+class LocationGraphSearch:
+    """
+    Searches a graph whose nodes are the start, the end and every location with a connection. Walking between two
+    nodes costs their Manhattan distance, so the blocks in between are never expanded and the query time depends on
+    the number of locations instead of the distance between the endpoints.
+    """
+    def __init__(self, storage: StorageProvider, max_expansions: typing.Optional[int] = None):
+        self.storage = storage
+        self.max_expansions = max_expansions
+
+    def _search(self, start: typing.Tuple[int, int], targets: typing.Set[typing.Tuple[int, int]],
+                limit: SearchLimit):
+        graph = self.storage.get_adjacency_graph()
+        # locations without connections are never worth walking to, the direct walk is at least as short
+        transit_positions = [graph.positions[index] for index in graph.connected_indices]
+        walk_targets = [pos for pos in targets if pos != start]
+        remaining = set(targets)
+
+        node_heap = [(0, start)]
+        node_map = {
+            start: None
+        }
+        costs = {
+            start: 0
+        }
+        # train edges are far cheaper than their Manhattan distance so there is no admissible distance heuristic,
+        # plain Dijkstra over the small graph is used instead
+        while node_heap:
+            cost, current = heapq.heappop(node_heap)
+            if cost > costs[current]:
+                continue
+            limit.expand(len(node_heap) + 1)
+            remaining.discard(current)
+            if not remaining:
+                break
+
+            edges = [(pos, None, AStar.distance_between_points(current, pos))
+                     for pos in walk_targets if pos != current]
+            edges.extend((pos, None, AStar.distance_between_points(current, pos))
+                         for pos in transit_positions if pos != current)
+            index = graph.get_index(current)
+            if index is not None:
+                for edge in graph.get_edge_range(index):
+                    edges.append((graph.positions[graph.targets[edge]], graph.connections[edge], graph.costs[edge]))
+
+            for next_pos, connection, edge_cost in edges:
+                new_cost = cost + edge_cost
+                if next_pos not in costs or new_cost < costs[next_pos]:
+                    costs[next_pos] = new_cost
+                    heapq.heappush(node_heap, (new_cost, next_pos))
+                    limit.push()
+                    node_map[next_pos] = AStarPosition(current, connection)
+
+        return node_map, costs
+
+    @staticmethod
+    def _make_path(node_map, end: typing.Tuple[int, int]):
+        if end not in node_map.keys():
+            return None
+
+        path = []
+        current = node_map[end]
+        while current is not None:
+            path.append(current)
+            current = node_map[current.pos]
+        path.reverse()
+        # the last walk can be thousands of blocks long, keep the end so the route reaches it
+        path.append(AStarPosition(end, None))
+        return path
+
+    def get_path_to(self, start_pos: Position, end_pos: Position, timelimit_ms: typing.Optional[int],
+                    stats: typing.Optional[SearchStats] = None):
+        end = end_pos.get_pos()
+        with SearchLimit(self.storage, timelimit_ms, self.max_expansions, stats) as limit:
+            node_map, costs = self._search(start_pos.get_pos(), {end}, limit)
+        return self._make_path(node_map, end), costs
+
+    def get_paths_to_many(self, start_pos: Position, end_positions: [Position], timelimit_ms: typing.Optional[int],
+                          stats: typing.Optional[SearchStats] = None):
+        """
+        One search from start_pos that stops once every end position is settled
+        :return: (path, cost) for every end position, in the same order
+        """
+        ends = [end_pos.get_pos() for end_pos in end_positions]
+        with SearchLimit(self.storage, timelimit_ms, self.max_expansions, stats) as limit:
+            node_map, costs = self._search(start_pos.get_pos(), set(ends), limit)
+        return [(self._make_path(node_map, end), costs.get(end)) for end in ends]
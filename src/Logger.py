@@ -1,5 +1,9 @@
 import datetime
+import heapq
 import sqlite3
+import sys
+import threading
+import time
 import typing
 from abc import ABC, abstractmethod
 from enum import Enum
@@ -55,7 +59,8 @@ class Logger(ABC):
     @staticmethod
     def create(logger_type, data):
         types = {
-            "db": DbLogger
+            "db": DbLogger,
+            "db_batched": BatchedDbLogger
         }
         if logger_type in types.keys():
             return types[logger_type](**data)
@@ -75,28 +80,70 @@ class Logger(ABC):
         pass
 
     @abstractmethod
-    def get_entry_range(self, begin_id, end_id):
+    def get_entry_range(self, begin_id, end_id, limit: typing.Optional[int] = None,
+                        min_level: typing.Optional[LogLevel] = None,
+                        begin_time: typing.Optional[datetime.datetime] = None,
+                        end_time: typing.Optional[datetime.datetime] = None, newest_first=False) -> [LogEntry]:
+        """
+        One page of entries. The next page begins after the id of the last entry of this one, so pages stay the same
+        while entries are added.
+        :param begin_id: Only entries after this id, None from the first
+        :param end_id: Only entries before this id, None up to the last
+        :param min_level: Only entries of this level or above
+        :param newest_first: The entries right before end_id instead of those right after begin_id, in reverse order
+        """
+        pass
+
+    def prune(self):
+        """
+        Remove the entries the retention policy no longer keeps
+        """
         pass
 
     @abstractmethod
     def format_log_entry(self, entry: LogEntry) -> str:
         pass
 
+    def flush(self):
+        """
+        Wait until every entry added so far is stored
+        """
+        pass
+
+    def close(self):
+        pass
+
 
 class DbLogger(Logger):
-    def __init__(self, db_path):
+    # entries added between two retention checks
+    _cls_prune_interval = 10_000
+
+    def __init__(self, db_path, retention_days: typing.Optional[float] = None,
+                 max_entries: typing.Optional[int] = None):
+        """
+        :param retention_days: Entries older than this are removed, None keeps them
+        :param max_entries: Only this many of the newest entries are kept, None keeps them all
+        """
         super().__init__()
+        self.db_path = db_path
         self.db_connection = sqlite3.connect(db_path)
         self.cursor = self.db_connection.cursor()
+        self.retention_days = retention_days
+        self.max_entries = max_entries
+        self.entries_since_prune = 0
 
         self.version = 1
         self._init_tables()
+        self.prune()
 
     def _init_tables(self):
         self.cursor.execute("CREATE TABLE IF NOT EXISTS config(key TEXT PRIMARY KEY, value TEXT)")
         self.cursor.execute("INSERT OR IGNORE INTO config(key, value) VALUES(?, ?) ", ("version", self.version,))
         self.cursor.execute("CREATE TABLE IF NOT EXISTS log_entries(id INTEGER PRIMARY KEY ASC, date INTEGER, "
                             "level INTEGER, text TEXT)")
+        # pages filtered by level or time are range scans of these
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS log_entries_level ON log_entries(level, id)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS log_entries_date ON log_entries(date)")
         self.db_connection.commit()
 
     def add_entry(self, entry: LogEntry):
@@ -104,6 +151,42 @@ class DbLogger(Logger):
                             (entry.get_timestamp(), entry.get_log_level(), entry.get_text(),))
         self.db_connection.commit()
         print(self.format_log_entry(entry))
+        self._count_added(1, self.db_connection)
+
+    def _count_added(self, num_entries: int, db_connection: sqlite3.Connection):
+        self.entries_since_prune += num_entries
+        if self.entries_since_prune >= DbLogger._cls_prune_interval:
+            self._prune(db_connection)
+
+    def prune(self):
+        self._prune(self.db_connection)
+
+    def _prune(self, db_connection: sqlite3.Connection):
+        self.entries_since_prune = 0
+        if self.retention_days is None and self.max_entries is None:
+            return
+        try:
+            with db_connection:
+                if self.retention_days is not None:
+                    oldest_time = datetime.datetime.now() - datetime.timedelta(days=self.retention_days)
+                    db_connection.execute("DELETE FROM log_entries WHERE date < ?", (oldest_time,))
+                if self.max_entries is not None:
+                    db_connection.execute("DELETE FROM log_entries WHERE id <= (SELECT id FROM log_entries "
+                                          "ORDER BY id DESC LIMIT 1 OFFSET ?)", (self.max_entries,))
+            # freed pages are reused by new entries, the file only has to shrink after a large part of it was removed
+            page_count, = db_connection.execute("PRAGMA page_count").fetchone()
+            free_pages, = db_connection.execute("PRAGMA freelist_count").fetchone()
+            if free_pages * 2 > page_count:
+                db_connection.execute("VACUUM")
+        # e.g. the database is locked by the logger of another process, the next check tries again
+        except sqlite3.Error as e:
+            self._report_error("Cannot prune the log: {}".format(e))
+
+    def _report_error(self, text: str):
+        """
+        Errors of the logger itself, the log may be the thing that cannot be written
+        """
+        sys.stderr.write(self.format_log_entry(LogEntry.create(LogLevel.Error, text)) + "\n")
 
     def get_next_entry(self, entry_id):
         if entry_id is None:
@@ -118,10 +201,164 @@ class DbLogger(Logger):
         return LogEntry(entry_data[0], entry_data[1], LogLevel.from_name(entry_data[2]), entry_data[3])
 
     def get_prev_entry(self, entry_id):
-        pass
+        if entry_id is None:
+            res = self.cursor.execute("SELECT id, date, level, text FROM log_entries ORDER BY id DESC LIMIT 1")
+        else:
+            res = self.cursor.execute("SELECT id, date, level, text FROM log_entries WHERE id < ? "
+                                      "ORDER BY id DESC LIMIT 1", (entry_id, ))
+        entry_data = res.fetchone()
+        if entry_data is None:
+            return None
 
-    def get_entry_range(self, begin_id, end_id):
-        pass
+        return LogEntry(entry_data[0], entry_data[1], LogLevel.from_name(entry_data[2]), entry_data[3])
+
+    def get_entry_range(self, begin_id, end_id, limit: typing.Optional[int] = None,
+                        min_level: typing.Optional[LogLevel] = None,
+                        begin_time: typing.Optional[datetime.datetime] = None,
+                        end_time: typing.Optional[datetime.datetime] = None, newest_first=False) -> [LogEntry]:
+        conditions = []
+        parameters = []
+        if begin_id is not None:
+            conditions.append("id > ?")
+            parameters.append(begin_id)
+        if end_id is not None:
+            conditions.append("id < ?")
+            parameters.append(end_id)
+        if begin_time is not None:
+            conditions.append("date >= ?")
+            parameters.append(begin_time)
+        if end_time is not None:
+            conditions.append("date < ?")
+            parameters.append(end_time)
+        if min_level is None:
+            return self._get_entries(conditions, parameters, limit, newest_first)
+
+        # one scan of the level index per level, each stops after limit entries, where level IN (...) would sort
+        # every entry of those levels; levels are stored by name
+        pages = [self._get_entries(conditions + ["level = ?"], parameters + [level.name], limit, newest_first)
+                 for level in LogLevel if level.value >= min_level.value]
+        entries = list(heapq.merge(*pages, key=lambda entry: entry.get_id(), reverse=newest_first))
+        return entries if limit is None else entries[:limit]
+
+    def _get_entries(self, conditions: [str], parameters: list, limit: typing.Optional[int],
+                     newest_first: bool) -> [LogEntry]:
+        query = "SELECT id, date, level, text FROM log_entries"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC" if newest_first else " ORDER BY id"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters = parameters + [limit]
+        return [LogEntry(entry_id, date, LogLevel.from_name(level), text)
+                for entry_id, date, level, text in self.cursor.execute(query, parameters)]
 
     def format_log_entry(self, entry: LogEntry) -> str:
         return "[{}] ({}): {}".format(entry.get_timestamp(), entry.get_log_level(), entry.get_text())
+
+    def close(self):
+        self.db_connection.close()
+
+
+class BatchedDbLogger(DbLogger):
+    """
+    DbLogger that queues entries and writes them from a background thread, one transaction per batch. A batch is
+    written once it has batch_size entries or its first entry waited flush_interval_ms. The database is in WAL mode
+    and commits do not wait for an fsync, a crash of the machine can lose the last batches but not damage the log.
+    """
+    def __init__(self, db_path, batch_size=256, flush_interval_ms=200, retention_days: typing.Optional[float] = None,
+                 max_entries: typing.Optional[int] = None):
+        super().__init__(db_path, retention_days, max_entries)
+        self.db_connection.execute("PRAGMA journal_mode=WAL")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.condition = threading.Condition()
+        self.queue: typing.List[LogEntry] = []
+        self.first_queued_time = None
+        self.queued_count = 0
+        self.written_count = 0
+        self.flush_requested = False
+        self.is_closed = False
+        self.writer_thread = threading.Thread(target=self._write_loop, name="BatchedDbLogger", daemon=True)
+        self.writer_thread.start()
+
+        # atexit handlers do not run in worker processes, multiprocessing finalizers run in both
+        from multiprocessing.util import Finalize
+        Finalize(self, self.close, exitpriority=10)
+
+    def add_entry(self, entry: LogEntry):
+        with self.condition:
+            if self.is_closed:
+                raise LoggerException("Logger is closed")
+            if not self.queue:
+                self.first_queued_time = time.monotonic()
+            self.queue.append(entry)
+            self.queued_count += 1
+            if len(self.queue) == 1 or len(self.queue) >= self.batch_size:
+                self.condition.notify_all()
+
+    def _write_loop(self):
+        db_connection = sqlite3.connect(self.db_path)
+        db_connection.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            with self.condition:
+                while not self.is_closed and not self.flush_requested and len(self.queue) < self.batch_size:
+                    if not self.queue:
+                        self.condition.wait()
+                        continue
+                    remaining = self.first_queued_time + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.queue
+                self.queue = []
+                self.flush_requested = False
+                if not batch and self.is_closed:
+                    break
+
+            if batch:
+                sys.stdout.write("".join(self.format_log_entry(entry) + "\n" for entry in batch))
+                # the thread has to keep running, a flush or close would otherwise wait for it forever
+                try:
+                    with db_connection:
+                        db_connection.executemany("INSERT INTO log_entries(date, level, text) VALUES(?, ?, ?)",
+                                                  [(entry.get_timestamp(), entry.get_log_level(), entry.get_text())
+                                                   for entry in batch])
+                except sqlite3.Error as e:
+                    self._report_error("Cannot write {} log entries: {}".format(len(batch), e))
+                else:
+                    self._count_added(len(batch), db_connection)
+
+            with self.condition:
+                self.written_count += len(batch)
+                self.condition.notify_all()
+        db_connection.close()
+
+    def flush(self):
+        with self.condition:
+            target_count = self.queued_count
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.written_count < target_count and self.writer_thread.is_alive():
+                self.condition.wait(self.flush_interval)
+
+    def get_next_entry(self, entry_id):
+        # reads go through the connection of this thread, they only see what the writer committed
+        self.flush()
+        return super().get_next_entry(entry_id)
+
+    def get_prev_entry(self, entry_id):
+        self.flush()
+        return super().get_prev_entry(entry_id)
+
+    def get_entry_range(self, *args, **kwargs) -> [LogEntry]:
+        self.flush()
+        return super().get_entry_range(*args, **kwargs)
+
+    def close(self):
+        with self.condition:
+            if self.is_closed:
+                return
+            self.is_closed = True
+            self.condition.notify_all()
+        self.writer_thread.join()
+        super().close()
@@ -0,0 +1,104 @@
+import math
+import threading
+import typing
+
+
+class LatencyHistogram:
+    """
+    Latencies counted in buckets whose bounds grow by a fixed factor, so percentiles are known to within that
+    factor whatever the number of samples, in constant memory
+    """
+    _cls_min_ms = 0.05
+    _cls_growth = 1.25
+    _cls_num_buckets = 80
+
+    def __init__(self):
+        self.buckets = [0] * LatencyHistogram._cls_num_buckets
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    @staticmethod
+    def get_bucket_bound(index: int) -> float:
+        return LatencyHistogram._cls_min_ms * LatencyHistogram._cls_growth ** index
+
+    def add(self, value_ms: float):
+        if value_ms <= LatencyHistogram._cls_min_ms:
+            index = 0
+        else:
+            index = math.ceil(math.log(value_ms / LatencyHistogram._cls_min_ms, LatencyHistogram._cls_growth))
+        self.buckets[min(index, LatencyHistogram._cls_num_buckets - 1)] += 1
+        self.count += 1
+        self.sum_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def get_percentile(self, percentile: float) -> typing.Optional[float]:
+        if self.count == 0:
+            return None
+        rank = math.ceil(self.count * percentile / 100)
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self.get_bucket_bound(index), self.max_ms)
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": self.sum_ms / self.count if self.count else None,
+            "p50_ms": self.get_percentile(50),
+            "p95_ms": self.get_percentile(95),
+            "p99_ms": self.get_percentile(99),
+            "max_ms": self.max_ms
+        }
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges of a running server. Gauges are read from a callback when the metrics
+    are reported.
+    """
+    def __init__(self):
+        self.counters: typing.Dict[str, int] = {}
+        self.histograms: typing.Dict[str, LatencyHistogram] = {}
+        self.gauges: typing.Dict[str, typing.Callable[[], typing.Optional[float]]] = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value_ms: float):
+        with self.lock:
+            if name not in self.histograms.keys():
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].add(value_ms)
+
+    def add_gauge(self, name: str, get_value: typing.Callable[[], typing.Optional[float]]):
+        self.gauges[name] = get_value
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "latencies": {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+                "gauges": {name: get_value() for name, get_value in self.gauges.items()}
+            }
+
+    def to_text(self) -> str:
+        """
+        One "name value" line per value, the format line based metrics collectors read
+        """
+        data = self.to_dict()
+        lines = []
+        for name, value in sorted(data["counters"].items()):
+            lines.append("{} {}".format(name, value))
+        for name, histogram in sorted(data["latencies"].items()):
+            for key, value in histogram.items():
+                if value is not None:
+                    lines.append("{}_{} {}".format(name, key, value))
+        for name, value in sorted(data["gauges"].items()):
+            if value is not None:
+                lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,115 @@
+import json
+import os.path
+import threading
+import typing
+from collections import OrderedDict
+from typing import Tuple
+
+from src.AStar import AStar
+from src.StorageProvider import StorageProvider
+
+
+class RouteCache:
+    """
+    Least recently used cache of the route entries of finished searches, keyed by engine and endpoints. Every entry
+    is dropped as soon as the storage revision changes.
+    """
+    _cls_file_version = 1
+
+    def __init__(self, storage: StorageProvider, max_entries: int = 1024,
+                 snap_distance: typing.Optional[int] = None):
+        """
+        :param snap_distance: Endpoints at most this many blocks from a location are moved onto it, so nearby
+        queries share an entry. None keeps endpoints as they are.
+        """
+        self.storage = storage
+        self.max_entries = max_entries
+        self.snap_distance = snap_distance
+        self.entries: OrderedDict = OrderedDict()
+        self.revision = storage.get_revision()
+        self.hits = 0
+        self.misses = 0
+        # searches of a thread pool share the planner
+        self.lock = threading.Lock()
+
+    def snap(self, pos: Tuple[int, int]) -> Tuple[int, int]:
+        if self.snap_distance is None or self.storage.get_location_at_pos(pos) is not None:
+            return pos
+        x, y = pos
+        # the Manhattan ball fits in the square of the same radius
+        candidates = self.storage.get_locations_in_area(x - self.snap_distance, x + self.snap_distance,
+                                                        y - self.snap_distance, y + self.snap_distance)
+        nearest = min(candidates,
+                      key=lambda location: AStar.distance_between_points(pos, location.get_pos()), default=None)
+        if nearest is None or AStar.distance_between_points(pos, nearest.get_pos()) > self.snap_distance:
+            return pos
+        return nearest.get_pos()
+
+    def _check_revision(self):
+        if self.revision != self.storage.get_revision():
+            self.entries.clear()
+            self.revision = self.storage.get_revision()
+
+    def get(self, engine_name: str, from_pos: Tuple[int, int], to_pos: Tuple[int, int]) -> typing.Optional[list]:
+        key = (engine_name, tuple(from_pos), tuple(to_pos))
+        with self.lock:
+            self._check_revision()
+            if key not in self.entries.keys():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, engine_name: str, from_pos: Tuple[int, int], to_pos: Tuple[int, int], route_entries: list,
+            revision: int):
+        """
+        :param revision: Storage revision the search started at, a result that raced a change is not kept
+        """
+        if self.max_entries <= 0:
+            return
+        key = (engine_name, tuple(from_pos), tuple(to_pos))
+        with self.lock:
+            self._check_revision()
+            if revision != self.revision:
+                return
+            self.entries[key] = route_entries
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries)
+            }
+
+    def save(self, path: str):
+        with self.lock:
+            self._check_revision()
+            data = {
+                "version": RouteCache._cls_file_version,
+                "fingerprint": self.storage.get_fingerprint(),
+                "entries": [[engine_name, from_pos, to_pos, route_entries]
+                            for (engine_name, from_pos, to_pos), route_entries in self.entries.items()]
+            }
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def load(self, path: str):
+        """
+        Load the entries saved by an earlier run, unless the map changed since
+        """
+        if self.max_entries <= 0 or not os.path.exists(path):
+            return
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != RouteCache._cls_file_version or \
+                data.get("fingerprint") != self.storage.get_fingerprint():
+            return
+        with self.lock:
+            self._check_revision()
+            for engine_name, from_pos, to_pos, route_entries in data["entries"][-self.max_entries:]:
+                self.entries[(engine_name, tuple(from_pos), tuple(to_pos))] = route_entries
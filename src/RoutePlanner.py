@@ -1,14 +1,20 @@
+import threading
 import typing
 from enum import Enum
 
-from src.AStar import AStar, AStarPosition, AStarTimelimitException
+from src.AStar import AStar, AStarPosition, AStarTimelimitException, AStarBudgetException, SearchStats
+from src.ContractionHierarchy import ContractionHierarchy
 from src.Location import Position, Location
+from src.LocationGraph import LocationGraphSearch
+from src.RouteCache import RouteCache
 from src.StorageProvider import StorageProvider
 
 
 class Route:
     def __init__(self):
         self.entries = []
+        # stats of the search that found the route, None when it came from the route cache
+        self.stats: typing.Optional[SearchStats] = None
 
     def add_entry(self, entry):
         self.entries.append(entry)
@@ -16,11 +22,34 @@ class Route:
     def get_entries(self):
         return self.entries
 
+    def set_stats(self, stats: SearchStats):
+        self.stats = stats
+
+    def get_stats(self) -> typing.Optional[SearchStats]:
+        return self.stats
+
 
 class RouteTimeoutException(Exception):
     pass
 
 
+class RouteBudgetException(RouteTimeoutException):
+    pass
+
+
+class RoutePlannerEngine(Enum):
+    Grid = "grid"
+    LocationGraph = "location_graph"
+    ContractionHierarchy = "contraction_hierarchy"
+
+    @classmethod
+    def from_value(cls, value):
+        for engine in RoutePlannerEngine:
+            if engine.value == value:
+                return engine
+        return None
+
+
 class RouteConnectionChanges(Enum):
     BoardTrain = 0
     LeaveTrain = 1
@@ -123,23 +152,124 @@ class RoutePath:
 
 
 class RoutePlanner:
-    def __init__(self, storage: StorageProvider):
-        self.storage = storage
+    _cls_engine_map = {
+        RoutePlannerEngine.Grid: AStar,
+        RoutePlannerEngine.LocationGraph: LocationGraphSearch,
+        RoutePlannerEngine.ContractionHierarchy: ContractionHierarchy
+    }
 
-    def plan_route(self, from_location: Position, to_location: Position, timelimit_ms: typing.Optional[int]) -> Route:
-        astar = AStar(self.storage)
+    def __init__(self, storage: StorageProvider, engine: RoutePlannerEngine = RoutePlannerEngine.Grid,
+                 route_cache: typing.Optional[RouteCache] = None, max_expansions: typing.Optional[int] = None):
+        """
+        :param max_expansions: Searches expanding more nodes than this fail with a RouteBudgetException
+        """
+        self.storage = storage
+        self.engine = engine
+        self.route_cache = route_cache
+        self.max_expansions = max_expansions
+        # searches keep their preprocessing between queries, so only make one per engine
+        self.searches = {}
+        # worker threads share the planner, a search registers itself with the storage once
+        self.searches_lock = threading.Lock()
+
+    def _make_search(self, engine: RoutePlannerEngine):
+        search = self.searches.get(engine)
+        if search is not None:
+            return search
+        with self.searches_lock:
+            if engine not in self.searches.keys():
+                self.searches[engine] = RoutePlanner._cls_engine_map[engine](self.storage, self.max_expansions)
+            return self.searches[engine]
+
+    def prepare(self, engine: typing.Optional[RoutePlannerEngine] = None, timeout: typing.Optional[float] = 0):
+        """
+        Makes the search of the engine so its preprocessing starts before the first route is planned
+        :param timeout: Seconds to wait for the preprocessing, None waits until it is done
+        """
+        search = self._make_search(engine if engine is not None else self.engine)
+        if isinstance(search, ContractionHierarchy) and timeout != 0:
+            search.wait_until_built(timeout)
+
+    def plan_route(self, from_location: Position, to_location: Position, timelimit_ms: typing.Optional[int],
+                   engine: typing.Optional[RoutePlannerEngine] = None) -> Route:
+        engine = engine if engine is not None else self.engine
+        if self.route_cache is not None:
+            from_location = Position(*self.route_cache.snap(from_location.get_pos()))
+            to_location = Position(*self.route_cache.snap(to_location.get_pos()))
+            cached_entries = self.route_cache.get(engine.value, from_location.get_pos(), to_location.get_pos())
+            if cached_entries is not None:
+                route = Route()
+                for entry in cached_entries:
+                    route.add_entry(entry)
+                return route
+
+        revision = self.storage.get_revision()
+        search = self._make_search(engine)
+        stats = SearchStats()
         try:
-            path, cost = astar.get_path_to(from_location, to_location, timelimit_ms)
+            path, cost = search.get_path_to(from_location, to_location, timelimit_ms, stats)
+        except AStarBudgetException:
+            raise RouteBudgetException()
         except AStarTimelimitException:
             raise RouteTimeoutException()
 
         route_paths = self._make_paths_from_astar_points(path)
         route = Route()
+        route.set_stats(stats)
         for path in route_paths:
             route.add_entry(path.to_dict())
 
+        if self.route_cache is not None:
+            self.route_cache.put(engine.value, from_location.get_pos(), to_location.get_pos(), route.get_entries(),
+                                 revision)
         return route
 
+    def plan_matrix_row(self, from_location: Position, to_locations: [Position], timelimit_ms: typing.Optional[int],
+                        include_routes: bool = False) -> dict:
+        """
+        Costs and walked or ridden distances from one origin to every destination, from a single search over the
+        location graph whatever the engine of the planner
+        :param include_routes: Also return the route entries to every destination
+        """
+        search = self._make_search(RoutePlannerEngine.LocationGraph)
+        try:
+            results = search.get_paths_to_many(from_location, to_locations, timelimit_ms)
+        except AStarBudgetException:
+            raise RouteBudgetException()
+        except AStarTimelimitException:
+            raise RouteTimeoutException()
+
+        row = {
+            "costs": [cost for _, cost in results],
+            "distances": [self._get_path_distance(path) for path, _ in results]
+        }
+        if include_routes:
+            row["routes"] = [[route_path.to_dict() for route_path in self._make_paths_from_astar_points(path)]
+                             if path is not None else None for path, _ in results]
+        return row
+
+    def plan_matrix(self, from_locations: [Position], to_locations: [Position], timelimit_ms: typing.Optional[int],
+                    include_routes: bool = False) -> dict:
+        rows = [self.plan_matrix_row(from_location, to_locations, timelimit_ms, include_routes)
+                for from_location in from_locations]
+        return RoutePlanner.merge_matrix_rows(rows)
+
+    @staticmethod
+    def merge_matrix_rows(rows: [dict]) -> dict:
+        matrix = {
+            "costs": [row["costs"] for row in rows],
+            "distances": [row["distances"] for row in rows]
+        }
+        if rows and "routes" in rows[0].keys():
+            matrix["routes"] = [row["routes"] for row in rows]
+        return matrix
+
+    @staticmethod
+    def _get_path_distance(path) -> typing.Optional[int]:
+        if path is None:
+            return None
+        return sum(AStar.distance_between_points(a.pos, b.pos) for a, b in zip(path, path[1:]))
+
     def _make_paths_from_astar_points(self, path) -> [RoutePath]:
         route_path = []
 
@@ -1,18 +1,101 @@
 import asyncio
 import json
+import multiprocessing
 import re
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from enum import Enum
 from json import JSONDecodeError
 
 from src.Config import Config, ConfigKeys, ConfigDataKeys
 from src.Location import Position
-from src.RoutePlanner import RoutePlanner, RouteTimeoutException
+from src.Logger import Logger, LogEntry, LogLevel
+from src.Metrics import Metrics
+from src.RouteCache import RouteCache
+from src.RoutePlanner import RoutePlanner, RouteTimeoutException, RoutePlannerEngine, RouteBudgetException
 from src.StorageProvider import StorageProvider
 
+# planner of a process pool worker, each worker loads its own storage
+_worker_planner: typing.Optional[RoutePlanner] = None
+
+
+def make_planner(config: Config, storage: StorageProvider) -> RoutePlanner:
+    planner_config = config.get_config_value(ConfigKeys.RoutePlannerConfig)
+    route_cache = None
+    if planner_config.get(ConfigDataKeys.RouteCacheSize) > 0:
+        route_cache = RouteCache(storage, planner_config.get(ConfigDataKeys.RouteCacheSize),
+                                 planner_config.get(ConfigDataKeys.RouteCacheSnapDistance))
+        if planner_config.get(ConfigDataKeys.RouteCachePath) is not None:
+            route_cache.load(planner_config.get(ConfigDataKeys.RouteCachePath))
+    planner = RoutePlanner(storage, planner_config.get(ConfigDataKeys.RoutePlannerEngine), route_cache,
+                           planner_config.get(ConfigDataKeys.RoutePlannerMaxExpansions))
+    # a contraction hierarchy is built in the background, requests are answered without it until it is done
+    planner.prepare()
+    return planner
+
+
+def _init_route_worker(config: Config):
+    global _worker_planner
+    logger = Logger.create(
+        config.get_config_value(ConfigKeys.LoggerType),
+        config.get_config_value(ConfigKeys.LoggerConfig)
+    )
+    storage = StorageProvider.create(
+        logger,
+        config.get_config_value(ConfigKeys.StorageProviderType),
+        config.get_config_value(ConfigKeys.StorageProviderConfig)
+    )
+    _worker_planner = make_planner(config, storage)
+
+
+def _call_route_worker(function, *args):
+    return function(_worker_planner, *args)
+
+
+def plan_route_job(planner: RoutePlanner, from_pos, to_pos, timeout_ms, engine):
+    route = planner.plan_route(Position(*from_pos), Position(*to_pos), timeout_ms, engine)
+    stats = route.get_stats()
+    return route.get_entries(), stats.to_dict() if stats is not None else None
+
+
+def plan_matrix_row_job(planner: RoutePlanner, from_pos, to_positions, timeout_ms, include_routes):
+    return planner.plan_matrix_row(Position(*from_pos), [Position(*pos) for pos in to_positions], timeout_ms,
+                                   include_routes)
+
+
+class NetworkWorkerTypes(Enum):
+    Thread = "thread"
+    Process = "process"
+
+
+class NetworkRequestInvalidException(Exception):
+    pass
+
 
 class NetworkProtocol(asyncio.Protocol):
+    """
+    Requests are json objects. A client that ends each request with a newline and gives it an "id" may keep the
+    connection open and send more requests before the replies arrive, each reply is a line holding the id and
+    either the "result" or an "error", written as soon as that request is done. A request without a newline gets
+    its reply on its own and the connection is closed, as older clients expect.
+    """
+    _cls_max_message_bytes = 1 << 20
+    _cls_max_matrix_cells = 10_000
+
     def __init__(self, interface):
         self.transport = None
         self.interface = interface
+        self.buffer = b""
+        # set once a newline terminated request arrives, the connection then stays open
+        self.framed = False
+        # the event loop only keeps weak references to tasks
+        self.tasks = set()
+        self.request_handlers = {
+            "route": self.handle_route_request,
+            "matrix": self.handle_matrix_request,
+            "stats": self.handle_stats_request
+        }
 
     def connection_made(self, transport):
         peer_name = transport.get_extra_info('peername')
@@ -24,63 +107,300 @@ class NetworkProtocol(asyncio.Protocol):
             "error": "Invalid"
         }).encode())
 
+    def report_internal_error(self, error: Exception):
+        self.interface.metrics.increment("errors_internal")
+        self.interface.storage.get_logger().add_entry(LogEntry.create(
+            LogLevel.Error, "Request failed: {}: {}".format(type(error).__name__, error)))
+
+    def _start_task(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
     def data_received(self, data):
-        message = data.decode()
-        print('Data received: {!r}'.format(message))
+        print('Data received: {!r}'.format(data))
+        self.buffer += data
 
-        try:
-            json_data = json.loads(message)
-        except JSONDecodeError:
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            if line.strip():
+                self.framed = True
+                self._start_task(self.reply_framed(line))
+
+        if len(self.buffer) > NetworkProtocol._cls_max_message_bytes:
+            self.interface.metrics.increment("errors_invalid")
             self.report_invalid()
             self.transport.close()
             return
 
-        if isinstance(json_data, dict) and "type" in json_data.keys():
-            if json_data["type"] == "route":
-                for v in ["x1", "x2", "y1", "y2"]:
-                    if v not in json_data.keys() or not isinstance(json_data[v], int):
-                        self.report_invalid()
-                        self.transport.close()
-                        return
-                pos1 = Position(json_data["x1"], json_data["y1"])
-                pos2 = Position(json_data["x2"], json_data["y2"])
-
-                timeout_ms = json_data["timeout"] if "timeout" in json_data.keys() else None
-                try:
-                    route = self.interface.planner.plan_route(pos1, pos2, timeout_ms)
-                    data = []
-                    for entry in route.get_entries():
-                        data.append(entry)
-                    self.transport.write(json.dumps(data).encode())
-                except RouteTimeoutException:
-                    self.transport.write(json.dumps({
-                        "error": "timeout"
-                    }).encode())
-            else:
+        if not self.framed and self.buffer.strip():
+            message = self.buffer.decode(errors="replace")
+            try:
+                json_data = json.loads(message)
+            except JSONDecodeError as e:
+                # a request split over several packets is only incomplete, not invalid
+                if e.pos >= len(message.rstrip()) or e.msg.startswith("Unterminated string"):
+                    return
+                self.interface.metrics.increment("errors_invalid")
                 self.report_invalid()
-        else:
-            self.report_invalid()
+                self.transport.close()
+                return
+            self.buffer = b""
+            self._start_task(self.reply_one_shot(json_data))
+
+    @staticmethod
+    def _decode_request(message: bytes):
+        try:
+            json_data = json.loads(message.decode())
+        except (JSONDecodeError, UnicodeDecodeError):
+            raise NetworkRequestInvalidException()
+        if not isinstance(json_data, dict) or "type" not in json_data.keys():
+            raise NetworkRequestInvalidException()
+        return json_data
+
+    async def process_request(self, json_data: dict):
+        request_type = json_data["type"]
+        if request_type not in self.request_handlers.keys():
+            raise NetworkRequestInvalidException()
+        metrics = self.interface.metrics
+        metrics.increment("requests_{}".format(request_type))
+        begin_time = time.perf_counter()
+        try:
+            return await self.request_handlers[request_type](json_data)
+        finally:
+            metrics.observe("latency_{}".format(request_type), (time.perf_counter() - begin_time) * 1000)
 
-        self.transport.close()
+    async def reply_one_shot(self, json_data):
+        try:
+            if not isinstance(json_data, dict) or "type" not in json_data.keys():
+                raise NetworkRequestInvalidException()
+            reply = await self.process_request(json_data)
+        except NetworkRequestInvalidException:
+            self.interface.metrics.increment("errors_invalid")
+            reply = {
+                "error": "Invalid"
+            }
+        except RouteBudgetException:
+            self.interface.metrics.increment("errors_budget")
+            reply = {
+                "error": "budget"
+            }
+        except RouteTimeoutException:
+            self.interface.metrics.increment("errors_timeout")
+            reply = {
+                "error": "timeout"
+            }
+        # the client waits for a reply whatever went wrong
+        except Exception as e:
+            self.report_internal_error(e)
+            reply = {
+                "error": "internal"
+            }
+        if not self.transport.is_closing():
+            self.transport.write(json.dumps(reply).encode())
+            self.transport.close()
+
+    async def reply_framed(self, message: bytes):
+        request_id = None
+        try:
+            json_data = self._decode_request(message)
+            request_id = json_data.get("id")
+            reply = {
+                "id": request_id,
+                "result": await self.process_request(json_data)
+            }
+        except NetworkRequestInvalidException:
+            self.interface.metrics.increment("errors_invalid")
+            reply = {
+                "id": request_id,
+                "error": "Invalid"
+            }
+        except RouteBudgetException:
+            self.interface.metrics.increment("errors_budget")
+            reply = {
+                "id": request_id,
+                "error": "budget"
+            }
+        except RouteTimeoutException:
+            self.interface.metrics.increment("errors_timeout")
+            reply = {
+                "id": request_id,
+                "error": "timeout"
+            }
+        # a pipelining client waits for every id it sent
+        except Exception as e:
+            self.report_internal_error(e)
+            reply = {
+                "id": request_id,
+                "error": "internal"
+            }
+        if not self.transport.is_closing():
+            self.transport.write(json.dumps(reply).encode() + b"\n")
+
+    async def handle_route_request(self, json_data: dict):
+        for v in ["x1", "x2", "y1", "y2"]:
+            if v not in json_data.keys() or not isinstance(json_data[v], int):
+                raise NetworkRequestInvalidException()
+        pos1 = (json_data["x1"], json_data["y1"])
+        pos2 = (json_data["x2"], json_data["y2"])
+
+        timeout_ms = self._get_timeout(json_data)
+        engine = None
+        if "engine" in json_data.keys():
+            engine = RoutePlannerEngine.from_value(json_data["engine"])
+            if engine is None:
+                raise NetworkRequestInvalidException()
+        include_stats = json_data.get("stats", False)
+        if not isinstance(include_stats, bool):
+            raise NetworkRequestInvalidException()
+
+        route_entries, stats = await self.interface.submit(plan_route_job, pos1, pos2, timeout_ms, engine)
+        if self.interface.log_stats and stats is not None:
+            self.interface.storage.get_logger().add_entry(LogEntry.create(
+                LogLevel.Debug, "Route from {} to {}: {}".format(pos1, pos2, json.dumps(stats))))
+        if include_stats:
+            return {
+                "route": route_entries,
+                "stats": stats
+            }
+        return route_entries
+
+    @staticmethod
+    def _get_timeout(json_data: dict) -> typing.Optional[int]:
+        timeout_ms = json_data.get("timeout")
+        if timeout_ms is not None and (not isinstance(timeout_ms, int) or isinstance(timeout_ms, bool)):
+            raise NetworkRequestInvalidException()
+        return timeout_ms
+
+    @staticmethod
+    def _get_position_list(json_data: dict, key: str):
+        if key not in json_data.keys() or not isinstance(json_data[key], list) or not json_data[key]:
+            raise NetworkRequestInvalidException()
+        positions = []
+        for pos in json_data[key]:
+            if not isinstance(pos, list) or len(pos) != 2 or not all(isinstance(v, int) for v in pos):
+                raise NetworkRequestInvalidException()
+            positions.append((pos[0], pos[1]))
+        return positions
+
+    async def handle_matrix_request(self, json_data: dict):
+        """
+        "origins" and "destinations" are lists of [x, y]. Each origin is one search reaching every destination, and
+        the origins are spread over the workers.
+        """
+        origins = self._get_position_list(json_data, "origins")
+        destinations = self._get_position_list(json_data, "destinations")
+        if len(origins) * len(destinations) > NetworkProtocol._cls_max_matrix_cells:
+            raise NetworkRequestInvalidException()
+        include_routes = json_data.get("routes", False)
+        if not isinstance(include_routes, bool):
+            raise NetworkRequestInvalidException()
+
+        timeout_ms = self._get_timeout(json_data)
+        rows = await asyncio.gather(*[
+            self.interface.submit(plan_matrix_row_job, origin, destinations, timeout_ms, include_routes)
+            for origin in origins
+        ])
+        return RoutePlanner.merge_matrix_rows(rows)
+
+    async def handle_stats_request(self, _):
+        return self.interface.metrics.to_dict()
 
 
 class ServerNetworkInterface:
     def __init__(self, config: Config, storage: StorageProvider):
         self.config = config
         self.storage = storage
-        self.planner = RoutePlanner(storage)
+        self.planner = make_planner(config, storage)
 
         config_data = self.config.get_config_value(ConfigKeys.NetworkInterfaceConfig)
         self.address = config_data.get(ConfigDataKeys.NetworkListenAddress)
         self.port = config_data.get(ConfigDataKeys.NetworkListenPort)
+        self.worker_type = NetworkWorkerTypes(config_data.get(ConfigDataKeys.NetworkWorkerType))
+        self.worker_count = config_data.get(ConfigDataKeys.NetworkWorkerCount)
+        self.log_stats = self.config.get_config_value(ConfigKeys.RoutePlannerConfig).get(
+            ConfigDataKeys.RoutePlannerLogStats)
+        self.metrics_port = config_data.get(ConfigDataKeys.NetworkMetricsPort)
+        self.executor = None
+
+        self.in_flight_searches = 0
+        self.metrics = Metrics()
+        self.metrics.add_gauge("in_flight_searches", lambda: self.in_flight_searches)
+        self.metrics.add_gauge("workers", lambda: self.worker_count)
+        # process workers keep their own caches, their hits are not seen here
+        self.metrics.add_gauge("heuristic_cache_hit_rate", lambda: self._get_rate(
+            self.storage.get_heuristic_cache_hits(), self.storage.get_heuristic_lookups()))
+        self.metrics.add_gauge("route_cache_hit_rate", self._get_route_cache_hit_rate)
 
-    async def serve_loop(self):
+    @staticmethod
+    def _get_rate(hits: int, lookups: int) -> typing.Optional[float]:
+        return hits / lookups if lookups else None
+
+    def _get_route_cache_hit_rate(self) -> typing.Optional[float]:
+        if self.planner.route_cache is None:
+            return None
+        stats = self.planner.route_cache.get_stats()
+        return self._get_rate(stats["hits"], stats["hits"] + stats["misses"])
+
+    def _search_done(self, _):
+        self.in_flight_searches -= 1
+
+    def _make_executor(self):
+        if self.worker_type == NetworkWorkerTypes.Process:
+            # forked workers would inherit the sockets of open connections and keep them from closing
+            return ProcessPoolExecutor(self.worker_count, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_route_worker, initargs=(self.config,))
+        return ThreadPoolExecutor(self.worker_count)
+
+    def submit(self, function, *args) -> asyncio.Future:
+        """
+        Run function(planner, *args) on a worker so searches do not hold up the event loop
+        """
         loop = asyncio.get_running_loop()
+        if self.worker_type == NetworkWorkerTypes.Process:
+            future = loop.run_in_executor(self.executor, _call_route_worker, function, *args)
+        else:
+            future = loop.run_in_executor(self.executor, function, self.planner, *args)
+        self.in_flight_searches += 1
+        future.add_done_callback(self._search_done)
+        return future
+
+    async def _write_metrics(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # answers anything, a plain connection and a http GET alike
+        try:
+            await asyncio.wait_for(reader.read(1024), 1)
+        except asyncio.TimeoutError:
+            pass
+        body = self.metrics.to_text().encode()
+        writer.write("HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\nContent-Length: {}\r\n\r\n".format(
+            len(body)).encode() + body)
+        await writer.drain()
+        writer.close()
 
-        server = await loop.create_server(lambda: NetworkProtocol(self), self.address, self.port)
+    async def serve_loop(self):
+        loop = asyncio.get_running_loop()
 
-        async with server:
-            await server.serve_forever()
+        # requests are accepted as soon as the server exists, they must not reach the default executor
+        self.executor = self._make_executor()
+        metrics_server = None
+        try:
+            server = await loop.create_server(lambda: NetworkProtocol(self), self.address, self.port)
+            if self.metrics_port is not None:
+                metrics_server = await asyncio.start_server(self._write_metrics, "127.0.0.1", self.metrics_port)
+            async with server:
+                await server.serve_forever()
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            self.executor.shutdown(cancel_futures=True)
+            self.save_route_cache()
+            self.storage.get_logger().flush()
+
+    def save_route_cache(self):
+        # process workers keep their own caches, only the one of this process is kept between runs
+        cache_path = self.config.get_config_value(ConfigKeys.RoutePlannerConfig).get(ConfigDataKeys.RouteCachePath)
+        if self.planner.route_cache is not None and cache_path is not None:
+            self.planner.route_cache.save(cache_path)
 
     def run(self):
         print("Listening on {}:{}".format(self.address, self.port))
@@ -91,14 +411,26 @@ class ClientNetworkProtocol(asyncio.Protocol):
     def __init__(self, message, on_con_lost):
         self.message = message
         self.on_con_lost = on_con_lost
+        self.transport = None
+        self.buffer = b""
 
     def connection_made(self, transport):
-        transport.write(self.message.encode())
+        self.transport = transport
+        transport.write(self.message.encode() + b"\n")
         print('Data sent: {!r}'.format(self.message))
 
     def data_received(self, data):
-        print('Data received: {!r}'.format(data.decode()))
-        print(self._route_json_to_list(json.loads(data.decode())))
+        self.buffer += data
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            print('Data received: {!r}'.format(line.decode()))
+            reply = json.loads(line.decode())
+            if "error" in reply.keys():
+                print("Error: {}".format(reply["error"]))
+            else:
+                print(self._route_json_to_list(reply["result"]))
+            # only one request is sent
+            self.transport.close()
 
     @staticmethod
     def _location_formatter(data):
@@ -135,7 +467,7 @@ class ClientNetworkProtocol(asyncio.Protocol):
         return '\n'.join(formatted)
 
     def connection_lost(self, exc):
-        print('The server closed the connection')
+        print('Connection closed')
         self.on_con_lost.set_result(True)
 
 
@@ -159,6 +491,7 @@ class ClientNetworkInterface:
 
         on_con_lost = loop.create_future()
         data = {
+            "id": 1,
             "type": "route",
             "x1": self.x1,
             "y1": self.y1,
@@ -0,0 +1,92 @@
+import threading
+import typing
+from typing import Tuple
+
+
+class StationIndex:
+    """
+    k-d tree over the positions of the station locations. Positions are rotated to (x + y, x - y), which turns the
+    Manhattan distance into the largest difference along either axis, so the tree can prune on a single axis.
+    The tree is rebuilt on the first lookup after it was invalidated.
+    """
+    def __init__(self, get_locations: typing.Callable[[], list]):
+        self.get_locations = get_locations
+        self.build_lock = threading.Lock()
+        # bumped by every invalidation, users of the station set compare it to see whether it may have changed
+        self.generation = 0
+        # generation the tree was built at, a change during a build leaves it behind so the next lookup rebuilds
+        self.built_generation: typing.Optional[int] = None
+        # implicit tree, the middle point of every range splits it on the axis of its depth
+        self.points: [Tuple[int, int]] = []
+
+    def invalidate(self, *_):
+        self.generation += 1
+
+    def _ensure_built(self):
+        if self.built_generation == self.generation:
+            return
+        with self.build_lock:
+            generation = self.generation
+            if self.built_generation == generation:
+                return
+            points = [(x + y, x - y) for x, y in
+                      (location.get_pos() for location in self.get_locations() if location.get_is_station())]
+            self._build(points, 0, len(points), 0)
+            self.points = points
+            self.built_generation = generation
+
+    def _build(self, points, begin, end, axis):
+        if end - begin <= 1:
+            return
+        points[begin:end] = sorted(points[begin:end], key=lambda point: point[axis])
+        middle = (begin + end) // 2
+        self._build(points, begin, middle, 1 - axis)
+        self._build(points, middle + 1, end, 1 - axis)
+
+    def get_points(self) -> [Tuple[int, int]]:
+        self._ensure_built()
+        return self.points
+
+    def set_points(self, points: [Tuple[int, int]]):
+        """
+        :param points: Tree of get_points built earlier for the same stations
+        """
+        with self.build_lock:
+            self.points = points
+            self.built_generation = self.generation
+
+    def get_station_positions(self) -> [Tuple[int, int]]:
+        self._ensure_built()
+        return [((u + v) // 2, (u - v) // 2) for u, v in self.points]
+
+    def get_nearest_distance(self, pos: Tuple[int, int]) -> typing.Optional[int]:
+        self._ensure_built()
+        points = self.points
+        if not points:
+            return None
+
+        x, y = pos
+        target = (x + y, x - y)
+        best = None
+        # (begin, end, axis, lower bound of the distance) ranges still to visit, the nearer half is visited first
+        stack = [(0, len(points), 0, 0)]
+        while stack:
+            begin, end, axis, bound = stack.pop()
+            if begin >= end or (best is not None and bound >= best):
+                continue
+            middle = (begin + end) // 2
+            point = points[middle]
+            distance = max(abs(point[0] - target[0]), abs(point[1] - target[1]))
+            if best is None or distance < best:
+                best = distance
+                if best == 0:
+                    break
+
+            axis_distance = target[axis] - point[axis]
+            if axis_distance < 0:
+                near, far = (begin, middle), (middle + 1, end)
+            else:
+                near, far = (middle + 1, end), (begin, middle)
+            stack.append((far[0], far[1], 1 - axis, max(bound, abs(axis_distance))))
+            stack.append((near[0], near[1], 1 - axis, bound))
+        return best
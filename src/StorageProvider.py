@@ -1,19 +1,24 @@
-import gc
+import hashlib
 import json
-import math
 import os.path
-import random
+import sqlite3
+import threading
+import time
 import typing
 from abc import ABC, abstractmethod
 from enum import Enum
-from multiprocessing.pool import ThreadPool, Pool
 from typing import Tuple
 
+from src.Adjacency import Adjacency, AdjacencyGraph
 from src.Cache import Cache
+from src.CacheBuilder import CacheBuildMethod
 from src.Connection import Connection
 from src.Direction import Direction
 from src.Location import Location
 from src.Logger import Logger, LogEntry, LogLevel
+from src.SpatialIndex import StationIndex
+from src.StorageSnapshot import StorageSnapshot, StorageSnapshotException, paused_gc
+from src.TileCache import TileCacheFile, TileCacheException
 
 
 class StorageException(Exception):
@@ -22,11 +27,15 @@ class StorageException(Exception):
 
 class StorageProviderTypes(Enum):
     JsonStorage = "json"
+    SqliteStorage = "sqlite"
 
 
 class StorageProvider(ABC):
     def __init__(self, logger: Logger):
         self.logger = logger
+        self.change_listeners: [typing.Callable[[], None]] = []
+        # bumped by every change to the locations or connections, results computed at an older revision are stale
+        self.revision = 0
 
         self.neighbour_directions = {
             Direction.North: (0, -1),
@@ -42,7 +51,8 @@ class StorageProvider(ABC):
     @staticmethod
     def create(logger: Logger, provider_type, data):
         provider_types = {
-            StorageProviderTypes.JsonStorage: JsonStorageProvider
+            StorageProviderTypes.JsonStorage: JsonStorageProvider,
+            StorageProviderTypes.SqliteStorage: SqliteStorageProvider
         }
         if provider_type in provider_types:
             return provider_types[provider_type](logger, **data)
@@ -52,6 +62,17 @@ class StorageProvider(ABC):
     def get_logger(self) -> Logger:
         return self.logger
 
+    def add_change_listener(self, listener: typing.Callable[[], None]):
+        self.change_listeners.append(listener)
+
+    def get_revision(self) -> int:
+        return self.revision
+
+    def _notify_changed(self):
+        self.revision += 1
+        for listener in self.change_listeners:
+            listener()
+
     @staticmethod
     def update_storage_version(self, old_version: typing.Optional[int], new_version: int):
         pass
@@ -60,6 +81,13 @@ class StorageProvider(ABC):
     def save(self):
         pass
 
+    @abstractmethod
+    def get_fingerprint(self) -> str:
+        """
+        Hash of the locations and connections, equal across runs as long as the map is the same
+        """
+        pass
+
     @abstractmethod
     def get_locations(self):
         pass
@@ -88,6 +116,13 @@ class StorageProvider(ABC):
     def get_pos_neighbours(self, pos: Tuple[int, int]):
         pass
 
+    @abstractmethod
+    def get_adjacency_graph(self) -> AdjacencyGraph:
+        """
+        Connections between the locations as flat arrays, rebuilt after the locations or connections change
+        """
+        pass
+
     @abstractmethod
     def get_location_at_pos(self, pos: Tuple[int, int]) -> Location:
         pass
@@ -96,10 +131,35 @@ class StorageProvider(ABC):
     def get_location_by_id(self, location_id):
         pass
 
+    def get_locations_in_area(self, min_x: int, max_x: int, min_y: int, max_y: int) -> [Location]:
+        """
+        Locations inside the rectangle, bounds included
+        """
+        return [location for location in self.get_locations()
+                if min_x <= location.get_pos()[0] <= max_x and min_y <= location.get_pos()[1] <= max_y]
+
     @abstractmethod
     def get_heuristic_distance_to_locations(self, current):
         pass
 
+    def get_load_timings(self) -> typing.Dict[str, float]:
+        """
+        Milliseconds the parts of loading the storage took, by part
+        """
+        return {}
+
+    def get_heuristic_cache_hits(self) -> int:
+        """
+        Number of heuristic distances answered from a cache so far
+        """
+        return 0
+
+    def get_heuristic_lookups(self) -> int:
+        """
+        Number of heuristic distances looked up so far, from a cache or not
+        """
+        return 0
+
     @staticmethod
     def _is_within_world(_):
         return True
@@ -114,7 +174,13 @@ class StorageProvider(ABC):
 
     @abstractmethod
     def make_cache(self, min_x: int, max_x: int, min_y: int, max_y: int, max_threads: int,
-                   callback: typing.Callable[[int], None]):
+                   callback: typing.Callable[[int, int], None],
+                   method: CacheBuildMethod = CacheBuildMethod.Vectorised):
+        """
+        Build the heuristic cache of a rectangle one tile at a time, skipping tiles an earlier build finished. A
+        cache built before the stations changed is updated, only tiles near the changed stations are recomputed.
+        :param callback: Called with the number of tiles done and the total number of tiles
+        """
         pass
 
 
@@ -135,33 +201,109 @@ class Neighbour:
 
 
 class JsonStorageProvider(StorageProvider):
-    def __init__(self, logger: Logger, path):
+    def __init__(self, logger: Logger, path, cache_path="./cache.dat.gz", tile_cache_path="./cache_tiles",
+                 tile_size=512, snapshot_path=None):
+        """
+        :param snapshot_path: Binary snapshot loaded instead of the json file while that is unchanged, rewritten when
+        it is not. None always parses the json file.
+        """
         super().__init__(logger)
         self.version: int = 1
         self.path = path
+        self.snapshot_path = snapshot_path
         self.locations_by_id = {}
         self.locations_by_position = {}
         self.locations_list = []
         self.connections = []
-        self.cache_path = "./cache.dat.gz"
+        self.station_index = StationIndex(self.get_locations)
+        self.add_change_listener(self.station_index.invalidate)
+        self.adjacency = Adjacency(self.get_locations)
+        self.add_change_listener(self.adjacency.invalidate)
+        self.cache_path = cache_path
+        self.tile_cache_path = tile_cache_path
+        self.tile_size = tile_size
+        self.tile_caches: [TileCacheFile] = []
+        # station generation the tile caches in use were checked at
+        self.tile_cache_generation: typing.Optional[int] = None
+        self.tile_cache_lock = threading.Lock()
         self.cache = Cache()
+        self.heuristic_lookups = 0
+        self.load_timings: typing.Dict[str, float] = {}
+
+        begin_time = time.perf_counter()
         if os.path.exists(self.cache_path):
             print("Loading from cache")
             self.cache.from_file(self.cache_path)
+        self._load_tile_caches()
+        self.load_timings["cache"] = (time.perf_counter() - begin_time) * 1000
+
+        begin_time = time.perf_counter()
+        with paused_gc():
+            self._load()
+        self.load_timings["data"] = (time.perf_counter() - begin_time) * 1000
+        self._check_tile_caches(log_stale=True)
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            source = f.read()
+        source_fingerprint = hashlib.sha256(source).digest()
+        if self.snapshot_path is not None and self._load_snapshot(source_fingerprint):
+            return
+
+        data = json.loads(source)
+
+        # updating the data does not load it but does modify it
+        save_required = False
+        if "version" not in data or data["version"] < self.version:
+            old_version = data["version"] if "version" in data.keys() else None
+            self.update_storage_version(old_version, self.version, data)
+            save_required = True
+
+        self.load_json_data(data)
+        if save_required:
+            # the snapshot is made from the upgraded file on the next load
+            self.save()
+        elif self.snapshot_path is not None:
+            self._save_snapshot(source_fingerprint)
+
+    def _load_snapshot(self, source_fingerprint: bytes) -> bool:
+        try:
+            payload = StorageSnapshot.load(self.snapshot_path, source_fingerprint)
+        except StorageSnapshotException as e:
+            self.logger.add_entry(LogEntry.create(LogLevel.Warning, str(e)))
+            return False
+        if payload is None:
+            return False
+
+        self.locations_list = payload["locations"]
+        self.connections = payload["connections"]
+        self.locations_by_id = payload["locations_by_id"]
+        self.locations_by_position = payload["locations_by_position"]
+        for location in self.locations_list:
+            location.set_station_listener(self.station_index.invalidate)
+        self.adjacency.set_graph(payload["adjacency_graph"], payload["line_ids"])
+        self.station_index.set_points(payload["station_points"])
+        return True
 
-        with open(path, "r") as f:
-            data = json.load(f)
-
-            # updating the data does not load it but does modify it
-            save_required = False
-            if "version" not in data or data["version"] < self.version:
-                old_version = data["version"] if "version" in data.keys() else None
-                self.update_storage_version(old_version, self.version, data)
-                save_required = True
+    def _save_snapshot(self, source_fingerprint: bytes):
+        payload = {
+            "locations": self.locations_list,
+            "connections": self.connections,
+            "locations_by_id": self.locations_by_id,
+            "locations_by_position": self.locations_by_position,
+            # built now so a load from the snapshot does not have to
+            "adjacency_graph": self.adjacency.get_graph(),
+            "line_ids": dict(self.adjacency.line_ids),
+            "station_points": self.station_index.get_points()
+        }
+        try:
+            StorageSnapshot.save(self.snapshot_path, source_fingerprint, payload)
+        except OSError as e:
+            self.logger.add_entry(LogEntry.create(LogLevel.Warning, "Cannot write storage snapshot {}: {}".format(
+                self.snapshot_path, e)))
 
-            self.load_json_data(data)
-            if save_required:
-                self.save()
+    def get_load_timings(self) -> typing.Dict[str, float]:
+        return self.load_timings
 
     def update_storage_version(self, old_version: typing.Optional[int], new_version: int, data):
         if old_version is None:
@@ -182,6 +324,7 @@ class JsonStorageProvider(StorageProvider):
                 from src.Location import Location
                 location = Location(location_data["id"], location_data["label"], location_data["x"], location_data["y"],
                                     location_data["description"])
+                location.set_station_listener(self.station_index.invalidate)
                 self.locations_by_id[location.get_id()] = location
                 self.locations_by_position[location.get_pos()] = location
                 self.locations_list.append(location)
@@ -197,7 +340,7 @@ class JsonStorageProvider(StorageProvider):
                     connection.add_location(self.locations_by_id[connection_location])
                 self.connections.append(connection)
 
-    def save(self):
+    def _make_json_data(self):
         data = {
             "version": self.version,
             "locations": [],
@@ -224,9 +367,14 @@ class JsonStorageProvider(StorageProvider):
                 "description": connection.get_description()
             }
             data["connections"].append(connection_data)
+        return data
 
+    def save(self):
         with open(self.path, "w") as f:
-            json.dump(data, f, indent=4)
+            json.dump(self._make_json_data(), f, indent=4)
+
+    def get_fingerprint(self) -> str:
+        return hashlib.sha256(json.dumps(self._make_json_data(), sort_keys=True).encode()).hexdigest()
 
     def get_locations(self):
         return self.locations_list
@@ -256,14 +404,15 @@ class JsonStorageProvider(StorageProvider):
         return neighbours
 
     def _get_neighbours_for_location(self, pos):
-        location = self.get_location_at_pos(pos)
-        neighbours = []
-        if location is not None:
-            for connection in location.get_connections():
-                other_location = connection.get_other_side(location)
-                if other_location is not None:
-                    neighbours.append(Neighbour(None, other_location.get_pos(), connection))
-        return neighbours
+        graph = self.get_adjacency_graph()
+        index = graph.get_index(pos)
+        if index is None:
+            return []
+        return [Neighbour(None, graph.positions[graph.targets[edge]], graph.connections[edge])
+                for edge in graph.get_edge_range(index)]
+
+    def get_adjacency_graph(self) -> AdjacencyGraph:
+        return self.adjacency.get_graph()
 
     def get_location_at_pos(self, pos: Tuple[int, int]):
         if pos in self.locations_by_position.keys():
@@ -277,37 +426,31 @@ class JsonStorageProvider(StorageProvider):
 
     def get_heuristic_distance_to_locations(self, pos: Tuple[int, int]) -> typing.Optional[int]:
         """
-        Check 1/8th of the locations we know about randomly, if they are a train then return the shortest distance
+        Find the distance to the nearest train station
         :param pos: Position to check
-        :return: The shortest distance to a train that we checked
+        :return: The Manhattan distance to the nearest station, None if there are no stations
         """
-        cached_value = self.cache.get_cached_value("heuristic", str(pos))
+        self.heuristic_lookups += 1
+        if self.tile_cache_generation != self.station_index.generation:
+            self._check_tile_caches()
+        cached_value = self.cache.get_cached_grid_value("heuristic", pos)
         if cached_value is not None:
             return cached_value
+        if self.cache.has_cached_values("heuristic"):
+            cached_value = self.cache.get_cached_value("heuristic", str(pos))
+            if cached_value is not None:
+                return cached_value
 
-        checking_locations = {}
-        checking_num = math.ceil(len(self.locations_list) / 8)
-        while checking_num > 0:
-            next_check_pos = random.randint(0, len(self.locations_list) - 1)
-            if next_check_pos in checking_locations.keys():
-                continue
-            checking_locations[next_check_pos] = self.locations_list[next_check_pos]
-            checking_num -= 1
+        return self._get_min_distance_to_locations(pos)
 
-        return self._get_min_distance_to_locations(list(checking_locations.values()), pos)
+    def get_heuristic_cache_hits(self) -> int:
+        return self.cache.get_hits("heuristic")
 
-    @staticmethod
-    def _get_min_distance_to_locations(checking_locations, pos):
-        min_distance = None
-        for v in checking_locations:
-            if not v.get_is_station():
-                continue
+    def get_heuristic_lookups(self) -> int:
+        return self.heuristic_lookups
 
-            from src.AStar import AStar
-            dist = AStar.distance_between_points(pos, v.get_pos())
-            if min_distance is None or dist < min_distance:
-                min_distance = dist
-        return min_distance
+    def _get_min_distance_to_locations(self, pos):
+        return self.station_index.get_nearest_distance(pos)
 
     @staticmethod
     def _check_keys(key, data, default_if_missing=False, default=None):
@@ -318,24 +461,30 @@ class JsonStorageProvider(StorageProvider):
                 raise StorageException("Key '{}' missing in json data".format(key))
 
     def add_location(self, location: Location):
+        location.set_station_listener(self.station_index.invalidate)
         self.locations_by_id[location.get_id()] = location
         self.locations_by_position[location.get_pos()] = location
         self.locations_list.append(location)
+        self._notify_changed()
 
     def delete_location(self, location: Location):
         del self.locations_by_id[location.get_id()]
         del self.locations_by_position[location.get_pos()]
         self.locations_list.remove(location)
-        for connection in location.get_connections():
+        location.set_station_listener(None)
+        for connection in list(location.get_connections()):
             self.delete_connection(connection)
+        self._notify_changed()
 
     def add_connection(self, connection: Connection):
         self.connections.append(connection)
+        self._notify_changed()
 
     def delete_connection(self, connection: Connection):
         self.connections.remove(connection)
         for location in connection.get_locations():
             location.remove_connection(connection)
+        self._notify_changed()
 
     def update_location(self, location):
         if location.get_prev_id() is not None:
@@ -346,50 +495,254 @@ class JsonStorageProvider(StorageProvider):
             location.clear_prev_pos()
         self.locations_by_id[location.get_id()] = location
         self.locations_by_position[location.get_pos()] = location
+        self._notify_changed()
 
     def update_connection(self, connection):
-        pass
+        self._notify_changed()
+
+    def _load_tile_caches(self):
+        with self.tile_cache_lock:
+            for tile_cache in self.tile_caches:
+                self.cache.remove_cached_grid("heuristic", tile_cache)
+                tile_cache.close()
+            self.tile_caches = []
+            self.tile_cache_generation = None
+        if not os.path.isdir(self.tile_cache_path):
+            return
+        for file_name in sorted(os.listdir(self.tile_cache_path)):
+            if file_name.startswith("heuristic_") and file_name.endswith(".tiles"):
+                try:
+                    self.tile_caches.append(TileCacheFile.open_for_reading(os.path.join(self.tile_cache_path,
+                                                                                        file_name)))
+                except TileCacheException as e:
+                    self.logger.add_entry(LogEntry.create(LogLevel.Warning, "{}, build the cache again".format(e)))
+
+    def _check_tile_caches(self, log_stale=False):
+        """
+        Use only the tile caches computed for the current stations, a stale heuristic can overestimate distances
+        """
+        with self.tile_cache_lock:
+            generation = self.station_index.generation
+            if not self.tile_caches:
+                self.tile_cache_generation = generation
+                return
+            fingerprint = TileCacheFile.get_station_fingerprint(self.station_index.get_station_positions())
+            for tile_cache in self.tile_caches:
+                self.cache.remove_cached_grid("heuristic", tile_cache)
+                if tile_cache.station_fingerprint == fingerprint:
+                    self.cache.add_cached_grid("heuristic", tile_cache)
+                elif log_stale:
+                    self.logger.add_entry(LogEntry.create(
+                        LogLevel.Warning, "Tile cache {} was built for other stations, build it again to update "
+                                          "it".format(tile_cache.path)))
+            self.tile_cache_generation = generation
+
+    def make_cache(self, min_x: int, max_x: int, min_y: int, max_y: int, max_threads: int,
+                   callback: typing.Callable[[int, int], None],
+                   method: CacheBuildMethod = CacheBuildMethod.Vectorised):
+        from src.CacheBuilder import make_tile_cache
+
+        os.makedirs(self.tile_cache_path, exist_ok=True)
+        file_name = TileCacheFile.get_file_name("heuristic", self.tile_size, min_x, max_x, min_y, max_y)
+        make_tile_cache(self.station_index.get_station_positions(), os.path.join(self.tile_cache_path, file_name),
+                        min_x, max_x, min_y, max_y, self.tile_size, max_threads, method, callback)
+        self._load_tile_caches()
+        self._check_tile_caches()
+
+
+class SqliteStorageProvider(JsonStorageProvider):
+    """
+    Map kept in a sqlite database. The searches still read the locations and connections from memory, but loading
+    them is a plain table scan and saving only writes the rows changed since the last save, in one transaction.
+    Positions are indexed by an R-tree for area queries.
+    """
+    def __init__(self, logger: Logger, path, json_path="./data.json", cache_path="./cache.dat.gz",
+                 tile_cache_path="./cache_tiles", tile_size=512, snapshot_path=None):
+        """
+        :param json_path: Map of the json storage imported when the database does not have a map yet, None to start
+        with an empty map
+        :param snapshot_path: Ignored, loading the tables is already a plain scan. Accepted so the storage config of
+        the json storage can be reused.
+        """
+        self.json_path = json_path
+        self.db_connection: typing.Optional[sqlite3.Connection] = None
+        # worker threads query the R-tree, the editor saves from the ui thread
+        self.db_lock = threading.Lock()
+        # rows by object identity, locations compare equal by position only
+        self.location_row_ids: typing.Dict[int, int] = {}
+        self.locations_by_row_id: typing.Dict[int, Location] = {}
+        self.connection_row_ids: typing.Dict[int, int] = {}
+        # changed since the last save
+        self.dirty_locations: typing.Dict[int, Location] = {}
+        self.dirty_connections: typing.Dict[int, Connection] = {}
+        self.deleted_location_row_ids: typing.Set[int] = set()
+        self.deleted_connection_row_ids: typing.Set[int] = set()
+        super().__init__(logger, path, cache_path, tile_cache_path, tile_size)
+
+    def _load(self):
+        self.db_connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._init_tables()
+        res = self.db_connection.execute("SELECT value FROM config WHERE key = ?", ("version",)).fetchone()
+        if res is None:
+            self._import_json()
+            return
+        if int(res[0]) > self.version:
+            raise StorageException("Cannot load storage version {}".format(res[0]))
+        self._load_rows()
+
+    def _init_tables(self):
+        with self.db_connection:
+            self.db_connection.execute("CREATE TABLE IF NOT EXISTS config(key TEXT PRIMARY KEY, value TEXT)")
+            self.db_connection.execute("CREATE TABLE IF NOT EXISTS locations(row_id INTEGER PRIMARY KEY, id TEXT, "
+                                       "label TEXT, x INTEGER, y INTEGER, description TEXT)")
+            self.db_connection.execute("CREATE TABLE IF NOT EXISTS connections(row_id INTEGER PRIMARY KEY, "
+                                       "location_1 INTEGER, location_2 INTEGER, weight NUMERIC, is_train INTEGER, "
+                                       "label TEXT, description TEXT)")
+            # integer coordinates, a location is a rectangle of one point
+            self.db_connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS location_positions USING "
+                                       "rtree_i32(id, min_x, max_x, min_y, max_y)")
+
+    def _import_json(self):
+        """
+        Move the map of a json storage into the empty database
+        """
+        if self.json_path is not None and os.path.exists(self.json_path):
+            with open(self.json_path, "r") as f:
+                data = json.load(f)
+            if "version" not in data or data["version"] < self.version:
+                old_version = data["version"] if "version" in data.keys() else None
+                self.update_storage_version(old_version, self.version, data)
+            self.load_json_data(data)
+            for location in self.locations_list:
+                self.dirty_locations[id(location)] = location
+            for connection in self.connections:
+                self.dirty_connections[id(connection)] = connection
+            self.logger.add_entry(LogEntry.create(LogLevel.Info, "Importing {} locations and {} connections from {}"
+                                                  .format(len(self.locations_list), len(self.connections),
+                                                          self.json_path)))
+        self.save()
+
+    def _load_rows(self):
+        for row_id, location_id, label, x, y, description in self.db_connection.execute(
+                "SELECT row_id, id, label, x, y, description FROM locations ORDER BY row_id"):
+            location = Location(location_id, label, x, y, description)
+            location.set_station_listener(self.station_index.invalidate)
+            self.locations_by_id[location.get_id()] = location
+            self.locations_by_position[location.get_pos()] = location
+            self.locations_list.append(location)
+            self.location_row_ids[id(location)] = row_id
+            self.locations_by_row_id[row_id] = location
+
+        for row_id, location_1, location_2, weight, is_train, label, description in self.db_connection.execute(
+                "SELECT row_id, location_1, location_2, weight, is_train, label, description FROM connections "
+                "ORDER BY row_id"):
+            connection = Connection(weight, bool(is_train), label, description)
+            for location_row_id in [location_1, location_2]:
+                if location_row_id not in self.locations_by_row_id.keys():
+                    raise StorageException("No such location row {}".format(location_row_id))
+                connection.add_location(self.locations_by_row_id[location_row_id])
+            self.connections.append(connection)
+            self.connection_row_ids[id(connection)] = row_id
 
-    def _make_cache_job(self, pos):
-        locations = self.get_locations()
-        return pos, self._get_min_distance_to_locations(locations, pos), []
+    def save(self):
+        new_location_row_ids = {}
+        new_connection_row_ids = {}
+        with self.db_lock, self.db_connection:
+            self.db_connection.execute("INSERT OR REPLACE INTO config(key, value) VALUES(?, ?)",
+                                       ("version", self.version))
+            self.db_connection.executemany("DELETE FROM connections WHERE row_id = ?",
+                                           [(row_id,) for row_id in self.deleted_connection_row_ids])
+            self.db_connection.executemany("DELETE FROM locations WHERE row_id = ?",
+                                           [(row_id,) for row_id in self.deleted_location_row_ids])
+            self.db_connection.executemany("DELETE FROM location_positions WHERE id = ?",
+                                           [(row_id,) for row_id in self.deleted_location_row_ids])
+
+            for location in self.dirty_locations.values():
+                x, y = location.get_pos()
+                values = (location.get_id(), location.get_label(), x, y, location.get_description())
+                row_id = self.location_row_ids.get(id(location))
+                if row_id is None:
+                    row_id = self.db_connection.execute("INSERT INTO locations(id, label, x, y, description) "
+                                                        "VALUES(?, ?, ?, ?, ?)", values).lastrowid
+                    new_location_row_ids[id(location)] = row_id
+                else:
+                    self.db_connection.execute("UPDATE locations SET id = ?, label = ?, x = ?, y = ?, description = ? "
+                                               "WHERE row_id = ?", values + (row_id,))
+                self.db_connection.execute("INSERT OR REPLACE INTO location_positions(id, min_x, max_x, min_y, max_y) "
+                                           "VALUES(?, ?, ?, ?, ?)", (row_id, x, x, y, y))
+
+            for connection in self.dirty_connections.values():
+                location_row_ids = [self.location_row_ids.get(id(location), new_location_row_ids.get(id(location)))
+                                    for location in connection.get_locations()]
+                if len(location_row_ids) != 2 or None in location_row_ids:
+                    raise StorageException("Connection {} does not join two stored locations".format(
+                        connection.get_label()))
+                values = (location_row_ids[0], location_row_ids[1], connection.get_weight(),
+                          1 if connection.get_is_train() else 0, connection.get_label(), connection.get_description())
+                row_id = self.connection_row_ids.get(id(connection))
+                if row_id is None:
+                    new_connection_row_ids[id(connection)] = self.db_connection.execute(
+                        "INSERT INTO connections(location_1, location_2, weight, is_train, label, description) "
+                        "VALUES(?, ?, ?, ?, ?, ?)", values).lastrowid
+                else:
+                    self.db_connection.execute("UPDATE connections SET location_1 = ?, location_2 = ?, weight = ?, "
+                                               "is_train = ?, label = ?, description = ? WHERE row_id = ?",
+                                               values + (row_id,))
+
+        # only known to be stored once the transaction committed
+        for location_key, row_id in new_location_row_ids.items():
+            self.location_row_ids[location_key] = row_id
+            self.locations_by_row_id[row_id] = self.dirty_locations[location_key]
+        self.connection_row_ids.update(new_connection_row_ids)
+        self.dirty_locations.clear()
+        self.dirty_connections.clear()
+        self.deleted_location_row_ids.clear()
+        self.deleted_connection_row_ids.clear()
+
+    def get_locations_in_area(self, min_x: int, max_x: int, min_y: int, max_y: int) -> [Location]:
+        with self.db_lock:
+            row_ids = [row[0] for row in self.db_connection.execute(
+                "SELECT id FROM location_positions WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?",
+                (min_x, max_x, min_y, max_y))]
+        dirty_locations = list(self.dirty_locations.values())
+        locations = [self.locations_by_row_id[row_id] for row_id in row_ids
+                     if row_id in self.locations_by_row_id.keys() and
+                     id(self.locations_by_row_id[row_id]) not in self.dirty_locations.keys()]
+        # added or moved since the last save, the index does not have their position yet
+        locations.extend(location for location in dirty_locations
+                         if min_x <= location.get_pos()[0] <= max_x and min_y <= location.get_pos()[1] <= max_y)
+        return locations
+
+    def _forget_location(self, location: Location):
+        self.dirty_locations.pop(id(location), None)
+        row_id = self.location_row_ids.pop(id(location), None)
+        if row_id is not None:
+            del self.locations_by_row_id[row_id]
+            self.deleted_location_row_ids.add(row_id)
 
-    @staticmethod
-    def _square_generator(min_x, max_x, min_y, max_y):
-        for i in range(min_x, max_x + 1):
-            for j in range(min_y, max_y + 1):
-                yield i, j
+    def add_location(self, location: Location):
+        super().add_location(location)
+        self.dirty_locations[id(location)] = location
 
-    @staticmethod
-    def _chunk_array(array, chunk_size):
-        for i in range(0, len(array), chunk_size):
-            yield array[i:i + chunk_size]
+    def delete_location(self, location: Location):
+        super().delete_location(location)
+        self._forget_location(location)
 
-    def make_cache(self, min_x: int, max_x: int, min_y: int, max_y: int, max_threads: int,
-                   callback: typing.Callable[[int], None]):
-        pool = Pool(max_threads)
-
-        positions = list(self._square_generator(min_x, max_x, min_y, max_y))
-        results_set = []
-        gc_every = 1000
-        last_gc = 0
-        for i, data_part in enumerate(self._chunk_array(positions, 1000000)):
-            results = pool.map(self._make_cache_job, data_part)
-            results_set.append(results)
-            if last_gc >= gc_every:
-                print("gc")
-                gc.collect()
-                last_gc = 0
-            last_gc += 1
-
-            callback(i * 1000)
-        pool.close()
-        pool.terminate()
-
-        for results in results_set:
-            for result in results:
-                pos, heuristic, neighbours = result
-                self.cache.set_cached_value("heuristic", str(pos), heuristic)
-                # self.cache.set_cached_value("neighbours", str(pos), neighbours)
-
-        self.cache.to_file(self.cache_path)
+    def update_location(self, location):
+        super().update_location(location)
+        self.dirty_locations[id(location)] = location
+
+    def add_connection(self, connection: Connection):
+        super().add_connection(connection)
+        self.dirty_connections[id(connection)] = connection
+
+    def delete_connection(self, connection: Connection):
+        super().delete_connection(connection)
+        self.dirty_connections.pop(id(connection), None)
+        row_id = self.connection_row_ids.pop(id(connection), None)
+        if row_id is not None:
+            self.deleted_connection_row_ids.add(row_id)
+
+    def update_connection(self, connection):
+        super().update_connection(connection)
+        self.dirty_connections[id(connection)] = connection
@@ -0,0 +1,73 @@
+import contextlib
+import gc
+import os.path
+import pickle
+import struct
+import typing
+
+
+class StorageSnapshotException(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def paused_gc():
+    """
+    Loading a map only creates objects that stay alive, collecting in between finds nothing and takes a good part
+    of the load time
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+class StorageSnapshot:
+    """
+    The loaded map of a storage written as one pickle, with the fingerprint of the file it was loaded from.
+    Loading it is a single read and rebuilds the objects without validating keys or calling their constructors.
+    Snapshots are written by the storage itself next to its data, they are as trusted as the data file.
+    """
+    _cls_magic = b"BRPSNAPS"
+    # bumped whenever the pickled classes change their fields
+    _cls_version = 1
+    # magic, version, sha256 of the source file
+    _cls_header = struct.Struct("<8sI32s")
+
+    @staticmethod
+    def save(path: str, source_fingerprint: bytes, payload: dict):
+        data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+        # a reader never sees a half written snapshot
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(StorageSnapshot._cls_header.pack(StorageSnapshot._cls_magic, StorageSnapshot._cls_version,
+                                                     source_fingerprint))
+            f.write(data)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path: str, source_fingerprint: bytes) -> typing.Optional[dict]:
+        """
+        :return: The payload, None if there is no snapshot or it was made from a different source file
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < StorageSnapshot._cls_header.size:
+            return None
+        magic, version, fingerprint = StorageSnapshot._cls_header.unpack_from(data)
+        if magic != StorageSnapshot._cls_magic:
+            raise StorageSnapshotException("{} is not a storage snapshot".format(path))
+        if version != StorageSnapshot._cls_version or fingerprint != source_fingerprint:
+            return None
+
+        try:
+            with paused_gc():
+                return pickle.loads(memoryview(data)[StorageSnapshot._cls_header.size:])
+        # a damaged stream can fail in about any way while it is unpickled
+        except Exception as e:
+            raise StorageSnapshotException("Corrupt storage snapshot {}: {}".format(path, e))
@@ -0,0 +1,121 @@
+import typing
+
+from PySide6.QtCore import QAbstractItemModel, QModelIndex, Qt
+from PySide6.QtGui import QIcon
+
+from src.Connection import Connection
+from src.Location import Location
+from src.StorageProvider import StorageProvider
+
+
+class StorageTreeModel(QAbstractItemModel):
+    """
+    Locations and connections of a storage under two group rows. Rows are only created for what the view shows and
+    edits signal just the rows they touch, so the cost of an edit does not grow with the size of the map.
+    """
+    _cls_group_labels = ["Locations", "Connections"]
+    _cls_locations_group = 0
+    _cls_connections_group = 1
+
+    def __init__(self, storage: StorageProvider, train_icon: QIcon, parent=None):
+        super().__init__(parent)
+        self.storage = storage
+        self.train_icon = train_icon
+        self.groups: typing.List[list] = [[], []]
+        # row of every item by object identity, locations compare equal by position only
+        self.rows: typing.List[typing.Dict[int, int]] = [{}, {}]
+        self.reload()
+
+    def reload(self):
+        self.beginResetModel()
+        self.groups = [list(self.storage.get_locations()), list(self.storage.get_connections())]
+        self.rows = [{id(item): row for row, item in enumerate(items)} for items in self.groups]
+        self.endResetModel()
+
+    @staticmethod
+    def _get_group(item) -> int:
+        return StorageTreeModel._cls_locations_group if isinstance(item, Location) \
+            else StorageTreeModel._cls_connections_group
+
+    def _get_item_index(self, item) -> typing.Optional[QModelIndex]:
+        group = self._get_group(item)
+        row = self.rows[group].get(id(item))
+        if row is None:
+            return None
+        # internal id 0 is a group row, children carry their group + 1
+        return self.createIndex(row, 0, group + 1)
+
+    def index(self, row: int, column: int, parent: QModelIndex = QModelIndex()) -> QModelIndex:
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, 0)
+        return self.createIndex(row, column, parent.row() + 1)
+
+    def parent(self, index: QModelIndex = QModelIndex()) -> QModelIndex:
+        if not index.isValid() or index.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(index.internalId() - 1, 0, 0)
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if not parent.isValid():
+            return len(self.groups)
+        if parent.internalId() == 0:
+            return len(self.groups[parent.row()])
+        return 0
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 1
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if index.internalId() == 0:
+            return StorageTreeModel._cls_group_labels[index.row()] if role == Qt.DisplayRole else None
+
+        item = self.groups[index.internalId() - 1][index.row()]
+        if role == Qt.UserRole:
+            return item
+        if isinstance(item, Location):
+            if role == Qt.DisplayRole:
+                return "{} {}".format(item.get_label(), item.get_pos())
+        elif isinstance(item, Connection):
+            if role == Qt.DisplayRole:
+                location_text = [x.get_label() for x in item.get_locations()]
+                return "{} and {}".format(location_text[0], location_text[1])
+            if role == Qt.DecorationRole and item.get_is_train():
+                return self.train_icon
+        return None
+
+    def update_item(self, item):
+        index = self._get_item_index(item)
+        if index is not None:
+            self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.DecorationRole])
+
+    def update_location(self, location: Location):
+        self.update_item(location)
+        # connection rows show the labels of both sides
+        for connection in location.get_connections():
+            self.update_item(connection)
+
+    def add_item(self, item):
+        group = self._get_group(item)
+        if id(item) in self.rows[group].keys():
+            return
+        row = len(self.groups[group])
+        self.beginInsertRows(self.createIndex(group, 0, 0), row, row)
+        self.groups[group].append(item)
+        self.rows[group][id(item)] = row
+        self.endInsertRows()
+
+    def remove_item(self, item):
+        group = self._get_group(item)
+        row = self.rows[group].get(id(item))
+        if row is None:
+            return
+        self.beginRemoveRows(self.createIndex(group, 0, 0), row, row)
+        del self.groups[group][row]
+        del self.rows[group][id(item)]
+        for moved_row in range(row, len(self.groups[group])):
+            self.rows[group][id(self.groups[group][moved_row])] = moved_row
+        self.endRemoveRows()
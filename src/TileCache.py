@@ -0,0 +1,276 @@
+import hashlib
+import mmap
+import os.path
+import struct
+import typing
+from typing import Tuple
+
+from src.Cache import CacheGrid
+
+
+class TileCacheException(Exception):
+    pass
+
+
+class TileCacheFile:
+    """
+    Cache of one rectangle split into square tiles of int32 values. The header is followed by an index holding the
+    file offset and the largest value of every tile, offset 0 for a tile that has not been written yet, and tiles are
+    appended in the order they finish, so an interrupted build keeps every tile it completed.
+    The header also holds the fingerprint of the stations the values were computed for and points at the list of
+    those stations, so a cache that no longer matches the map is detected and can be updated tile by tile. While an
+    update runs the fingerprint is unknown and the header also points at every station changed by the updates
+    since the listed stations, interrupted ones included.
+    Files are read through mmap, opening one costs the same whatever its size and only the pages of the index and
+    tiles that lookups touch are read, from the page cache that every process mapping the file shares.
+    """
+    _cls_magic = b"BRPTILES"
+    _cls_version = 2
+    # magic, version, tile size, min x, max x, min y, max y, station fingerprint, station list offset and count,
+    # changed station list offset and count
+    _cls_header = struct.Struct("<8sIIqqqq32sqqqq")
+    # offset, largest value
+    _cls_index_entry = struct.Struct("<qi")
+    _cls_value = struct.Struct("<i")
+    _cls_station = struct.Struct("<qq")
+    # fingerprint of a cache that is being updated, its tiles are a mix of station sets
+    _cls_unknown_fingerprint = bytes(32)
+
+    def __init__(self, path: str, tile_size: int, min_x: int, max_x: int, min_y: int, max_y: int):
+        self.path = path
+        self.tile_size = tile_size
+        self.min_x = min_x
+        self.max_x = max_x
+        self.min_y = min_y
+        self.max_y = max_y
+        self.tiles_x = (max_x - min_x) // tile_size + 1
+        self.tiles_y = (max_y - min_y) // tile_size + 1
+        self.num_tiles = self.tiles_x * self.tiles_y
+        self.tile_bytes = tile_size * tile_size * 4
+        self.index_offset = TileCacheFile._cls_header.size
+        self.station_fingerprint = TileCacheFile._cls_unknown_fingerprint
+        self.stations_offset = 0
+        self.num_stations = 0
+        self.changed_stations_offset = 0
+        self.num_changed_stations = 0
+        self.file = None
+        self.mmap: typing.Optional[mmap.mmap] = None
+        # only loaded when writing, readers look offsets up in the mapping
+        self.offsets: typing.Optional[typing.List[int]] = None
+        self.max_values: typing.Optional[typing.List[int]] = None
+
+    @staticmethod
+    def get_file_name(cache_type: str, tile_size: int, min_x: int, max_x: int, min_y: int, max_y: int):
+        return "{}_{}_{}_{}_{}_{}.tiles".format(cache_type, min_x, max_x, min_y, max_y, tile_size)
+
+    @staticmethod
+    def get_station_fingerprint(stations: [Tuple[int, int]]) -> bytes:
+        """
+        The same for the same set of station positions, whatever their order
+        """
+        fingerprint = hashlib.sha256()
+        for station in sorted(stations):
+            fingerprint.update(TileCacheFile._cls_station.pack(*station))
+        return fingerprint.digest()
+
+    def _pack_header(self):
+        return TileCacheFile._cls_header.pack(TileCacheFile._cls_magic, TileCacheFile._cls_version, self.tile_size,
+                                              self.min_x, self.max_x, self.min_y, self.max_y,
+                                              self.station_fingerprint, self.stations_offset, self.num_stations,
+                                              self.changed_stations_offset, self.num_changed_stations)
+
+    def _is_same_area(self, other: 'TileCacheFile') -> bool:
+        return (self.tile_size, self.min_x, self.max_x, self.min_y, self.max_y) == \
+            (other.tile_size, other.min_x, other.max_x, other.min_y, other.max_y)
+
+    @staticmethod
+    def _read_header(f, path):
+        header_data = f.read(TileCacheFile._cls_header.size)
+        if len(header_data) != TileCacheFile._cls_header.size:
+            raise TileCacheException("Tile cache {} is truncated".format(path))
+        magic, version = struct.unpack_from("<8sI", header_data)
+        if magic != TileCacheFile._cls_magic:
+            raise TileCacheException("{} is not a tile cache".format(path))
+        if version != TileCacheFile._cls_version:
+            raise TileCacheException("Unknown tile cache version {} in {}".format(version, path))
+        _, _, tile_size, min_x, max_x, min_y, max_y, *stations_fields = TileCacheFile._cls_header.unpack(header_data)
+        tile_cache = TileCacheFile(path, tile_size, min_x, max_x, min_y, max_y)
+        tile_cache.station_fingerprint, tile_cache.stations_offset, tile_cache.num_stations, \
+            tile_cache.changed_stations_offset, tile_cache.num_changed_stations = stations_fields
+        return tile_cache
+
+    def _write_header(self):
+        self.file.seek(0)
+        self.file.write(self._pack_header())
+        self.file.flush()
+
+    def _read_index(self):
+        self.file.seek(self.index_offset)
+        index_data = self.file.read(self.num_tiles * TileCacheFile._cls_index_entry.size)
+        entries = list(TileCacheFile._cls_index_entry.iter_unpack(index_data))
+        self.offsets = [offset for offset, _ in entries]
+        self.max_values = [max_value for _, max_value in entries]
+
+    @staticmethod
+    def open_for_reading(path: str) -> 'TileCacheFile':
+        with open(path, "rb") as f:
+            tile_cache = TileCacheFile._read_header(f, path)
+            # the mapping stays valid after the file is closed
+            tile_cache.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return tile_cache
+
+    @staticmethod
+    def open_for_writing(path: str, tile_size: int, min_x: int, max_x: int, min_y: int, max_y: int,
+                         stations: [Tuple[int, int]]) -> 'TileCacheFile':
+        """
+        Open the cache of the same rectangle at path, or start a new one for the stations. A cache whose station
+        fingerprint differs from the one of the stations keeps its tiles, they are updated between begin_update and
+        end_update.
+        """
+        tile_cache = TileCacheFile(path, tile_size, min_x, max_x, min_y, max_y)
+        if os.path.exists(path):
+            f = open(path, "r+b")
+            try:
+                existing = TileCacheFile._read_header(f, path)
+            except TileCacheException:
+                # older versions are rebuilt
+                existing = None
+            if existing is not None and existing._is_same_area(tile_cache):
+                existing.file = f
+                existing._read_index()
+                return existing
+            f.close()
+
+        tile_cache.file = open(path, "w+b")
+        tile_cache.file.write(tile_cache._pack_header())
+        tile_cache.file.write(bytes(tile_cache.num_tiles * TileCacheFile._cls_index_entry.size))
+        tile_cache.offsets = [0] * tile_cache.num_tiles
+        tile_cache.max_values = [CacheGrid.empty_value] * tile_cache.num_tiles
+        tile_cache.stations_offset = tile_cache._append_stations(stations)
+        tile_cache.num_stations = len(stations)
+        tile_cache.station_fingerprint = TileCacheFile.get_station_fingerprint(stations)
+        tile_cache._write_header()
+        return tile_cache
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def get_tile_origin(self, index: int) -> Tuple[int, int]:
+        return (self.min_x + (index % self.tiles_x) * self.tile_size,
+                self.min_y + (index // self.tiles_x) * self.tile_size)
+
+    def get_tile_distance(self, index: int, pos: Tuple[int, int]) -> int:
+        """
+        Manhattan distance from pos to the nearest cell of a tile
+        """
+        tile_min_x, tile_min_y = self.get_tile_origin(index)
+        x, y = pos
+        return max(tile_min_x - x, 0, x - (tile_min_x + self.tile_size - 1)) + \
+            max(tile_min_y - y, 0, y - (tile_min_y + self.tile_size - 1))
+
+    def has_tile(self, index: int) -> bool:
+        return self.offsets[index] != 0
+
+    def get_max_value(self, index: int) -> int:
+        return self.max_values[index]
+
+    def get_num_tiles_written(self) -> int:
+        return sum(1 for offset in self.offsets if offset != 0)
+
+    def get_affected_tiles(self, changed_stations: typing.Iterable[Tuple[int, int]]) -> typing.Set[int]:
+        """
+        Written tiles that can hold a different value once the given stations were added or removed. A cell only
+        changes if a changed station is at most its current value away, as the new nearest station or as the old
+        one, so a tile farther than its largest value from every changed station keeps all its values.
+        """
+        changed_stations = list(changed_stations)
+        if not changed_stations:
+            return set()
+        affected = set()
+        for index in range(self.num_tiles):
+            if not self.has_tile(index):
+                continue
+            max_value = self.max_values[index]
+            # empty tiles were computed without any stations
+            if max_value == CacheGrid.empty_value or \
+                    any(self.get_tile_distance(index, station) <= max_value for station in changed_stations):
+                affected.add(index)
+        return affected
+
+    def write_tile(self, index: int, data: bytes, max_value: int):
+        if len(data) != self.tile_bytes:
+            raise TileCacheException("Tile of {} bytes, expected {}".format(len(data), self.tile_bytes))
+        offset = self.offsets[index]
+        if offset == 0:
+            # the data is on disk before the index points at it, a crash in between only loses this tile
+            offset = self.file.seek(0, os.SEEK_END)
+        else:
+            # updated tiles keep their place, the cache is marked unknown while they are rewritten
+            self.file.seek(offset)
+        self.file.write(data)
+        self.file.flush()
+        self.file.seek(self.index_offset + index * TileCacheFile._cls_index_entry.size)
+        self.file.write(TileCacheFile._cls_index_entry.pack(offset, max_value))
+        self.file.flush()
+        self.offsets[index] = offset
+        self.max_values[index] = max_value
+
+    def _read_stations(self, offset: int, count: int) -> [Tuple[int, int]]:
+        self.file.seek(offset)
+        return list(TileCacheFile._cls_station.iter_unpack(self.file.read(count * TileCacheFile._cls_station.size)))
+
+    def _append_stations(self, stations: [Tuple[int, int]]) -> int:
+        # the list is on disk before the header points at it
+        offset = self.file.seek(0, os.SEEK_END)
+        self.file.write(b"".join(TileCacheFile._cls_station.pack(*station) for station in stations))
+        self.file.flush()
+        return offset
+
+    def begin_update(self, stations: [Tuple[int, int]]) -> typing.Set[Tuple[int, int]]:
+        """
+        Mark the cache as being rewritten for other stations, until end_update
+        :return: Stations added or removed since the tiles were computed. Tiles rewritten by interrupted updates hold
+        the values of the stations of those updates, their changes are included too.
+        """
+        changed = set(self._read_stations(self.stations_offset, self.num_stations)) ^ set(stations)
+        if self.station_fingerprint == TileCacheFile._cls_unknown_fingerprint:
+            changed |= set(self._read_stations(self.changed_stations_offset, self.num_changed_stations))
+        # every update until one finishes adds to the list, a tile can hold the values of any of them
+        self.changed_stations_offset = self._append_stations(sorted(changed))
+        self.num_changed_stations = len(changed)
+        self.station_fingerprint = TileCacheFile._cls_unknown_fingerprint
+        self._write_header()
+        return changed
+
+    def end_update(self, stations: [Tuple[int, int]]):
+        """
+        :param stations: The stations given to begin_update, every tile they changed was rewritten
+        """
+        self.stations_offset = self._append_stations(stations)
+        self.num_stations = len(stations)
+        self.station_fingerprint = TileCacheFile.get_station_fingerprint(stations)
+        self.changed_stations_offset = 0
+        self.num_changed_stations = 0
+        self._write_header()
+
+    def contains(self, pos: Tuple[int, int]) -> bool:
+        x, y = pos
+        return self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y
+
+    def get_value(self, pos: Tuple[int, int]) -> typing.Optional[int]:
+        x, y = pos
+        tile_x, cell_x = divmod(x - self.min_x, self.tile_size)
+        tile_y, cell_y = divmod(y - self.min_y, self.tile_size)
+        index = tile_y * self.tiles_x + tile_x
+        offset, _ = TileCacheFile._cls_index_entry.unpack_from(
+            self.mmap, self.index_offset + index * TileCacheFile._cls_index_entry.size)
+        # tiles written after the file was mapped are past its end
+        if offset == 0 or offset + self.tile_bytes > len(self.mmap):
+            return None
+        value, = TileCacheFile._cls_value.unpack_from(self.mmap, offset + (cell_y * self.tile_size + cell_x) * 4)
+        return None if value == CacheGrid.empty_value else value
@@ -22,11 +22,22 @@ class Ui_Form(object):
         self.verticalLayout.setObjectName(u"verticalLayout")
         self.log_list = QListWidget(Form)
         self.log_list.setObjectName(u"log_list")
+        self.log_list.setUniformItemSizes(True)
 
         self.verticalLayout.addWidget(self.log_list)
 
         self.horizontalLayout = QHBoxLayout()
         self.horizontalLayout.setObjectName(u"horizontalLayout")
+        self.level_filter_label = QLabel(Form)
+        self.level_filter_label.setObjectName(u"level_filter_label")
+
+        self.horizontalLayout.addWidget(self.level_filter_label)
+
+        self.level_filter = QComboBox(Form)
+        self.level_filter.setObjectName(u"level_filter")
+
+        self.horizontalLayout.addWidget(self.level_filter)
+
         self.horizontalSpacer = QSpacerItem(40, 20, QSizePolicy.Expanding, QSizePolicy.Minimum)
 
         self.horizontalLayout.addItem(self.horizontalSpacer)
@@ -47,6 +58,7 @@ class Ui_Form(object):
 
     def retranslateUi(self, Form):
         Form.setWindowTitle(QCoreApplication.translate("Form", u"Form", None))
+        self.level_filter_label.setText(QCoreApplication.translate("Form", u"Level", None))
         self.pushButton.setText(QCoreApplication.translate("Form", u"Ok", None))
     # retranslateUi
 
@@ -39,10 +39,7 @@ class Ui_MainWindow(object):
         self.centralwidget.setObjectName(u"centralwidget")
         self.horizontalLayout_2 = QHBoxLayout(self.centralwidget)
         self.horizontalLayout_2.setObjectName(u"horizontalLayout_2")
-        self.storageView = QTreeWidget(self.centralwidget)
-        __qtreewidgetitem = QTreeWidgetItem()
-        __qtreewidgetitem.setText(0, u"1");
-        self.storageView.setHeaderItem(__qtreewidgetitem)
+        self.storageView = QTreeView(self.centralwidget)
         self.storageView.setObjectName(u"storageView")
         sizePolicy = QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Expanding)
         sizePolicy.setHorizontalStretch(0)
@@ -53,6 +50,7 @@ class Ui_MainWindow(object):
         self.storageView.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
         self.storageView.setSizeAdjustPolicy(QAbstractScrollArea.AdjustIgnored)
         self.storageView.setAlternatingRowColors(True)
+        self.storageView.setUniformRowHeights(True)
         self.storageView.setSortingEnabled(True)
         self.storageView.header().setVisible(False)
 